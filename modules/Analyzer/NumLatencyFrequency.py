@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 from bcc import BPF
+from bcc.table import PerfEventArray
 from ctypes import *
 import argparse
 import os
@@ -1545,7 +1546,63 @@ def create_kfree_skb_text():
     """
 
 
+# Compiled programs by program text. The text does not depend on the session (flows are
+# chosen through the five_tuple_filter maps), so a new session takes an idle compiled
+# program instead of running clang again, and gives it back when it ends.
+# Idle programs have nothing attached, at most BPF_POOL_IDLE of them per text and
+# BPF_POOL_MAX in all are kept, the others are freed when their session ends.
+bpf_pool = {}
+BPF_POOL_IDLE = 1
+BPF_POOL_MAX = 4
+SESSION_MAPS = ['start', 'start_translink', 'start_transnetwork',
+                'five_tuple_filter_ipv4', 'five_tuple_filter_ipv6']
+
+
+def acquire_bpf(bpf_text):
+    idle = bpf_pool.setdefault(bpf_text, [])
+    if not idle:
+        # Loading attaches the TRACEPOINT_PROBEs
+        return BPF(text=bpf_text)
+    b, tracepoints = idle.pop()
+    for tp in tracepoints:
+        b.attach_tracepoint(tp=tp, fn_name=b'tracepoint__' + tp.replace(b':', b'__'))
+    return b
+
+
+def release_bpf(bpf_text, b):
+    # Detach the session's kprobes and tracepoints, close its perf buffers and clear its state
+    idle = bpf_pool.setdefault(bpf_text, [])
+    if len(idle) >= BPF_POOL_IDLE or sum(len(items) for items in bpf_pool.values()) >= BPF_POOL_MAX:
+        b.cleanup()
+        return
+    try:
+        for ev_name in list(b.kprobe_fds.keys()):
+            b.detach_kprobe_event(ev_name)
+        tracepoints = list(b.tracepoint_fds.keys())
+        for tp in tracepoints:
+            b.detach_tracepoint(tp)
+        for table in list(b.tables.values()):
+            if isinstance(table, PerfEventArray):
+                table.clear()
+        for name in SESSION_MAPS:
+            b[name].clear()
+    except Exception as e:
+        print(f'BPF program dropped from pool: {str(e)}')
+        b.cleanup()
+        return
+    idle.append((b, tracepoints))
+
+
 def enter(ipv4_flag, ipv6_flag, sip, dip, sport, dport, protocol):
+    held = []
+    try:
+        yield from trace_session(held, ipv4_flag, ipv6_flag, sip, dip, sport, dport, protocol)
+    finally:
+        for bpf_text, b in held:
+            release_bpf(bpf_text, b)
+
+
+def trace_session(held, ipv4_flag, ipv6_flag, sip, dip, sport, dport, protocol):
     print('enter enter_linknetwork')
     if not ipv4_flag and not ipv6_flag:
         yield json.dumps({'error': 'At least one of IPv4 or IPv6 must be enabled'}) + '\n'
@@ -1578,7 +1635,8 @@ def enter(ipv4_flag, ipv6_flag, sip, dip, sport, dport, protocol):
             bpf_text += create_kfree_skb_text()
             kfree_skb_traceable = True
 
-    b = BPF(text=bpf_text)
+    b = acquire_bpf(bpf_text)
+    held.append((bpf_text, b))
 
     # 事件队列
     event_queue = queue.Queue()
@@ -39,6 +39,7 @@ def validate_params(data, required_keys):
 
 async def handle_client(websocket):
     active_task = None
+    active_generator = None
 
     try:
         async for message in websocket:
@@ -81,9 +82,13 @@ async def handle_client(websocket):
                         await active_task
                     except asyncio.CancelledError:
                         print("旧任务已取消")
+                # 关闭旧生成器，归还其 BPF 程序
+                if active_generator:
+                    active_generator.close()
 
                 # 获取生成器（假设是同步生成器）
                 generator = handler_info["func"](**params)
+                active_generator = generator
 
                 async def send_loop():
                     try:
@@ -118,6 +123,8 @@ async def handle_client(websocket):
                 await active_task
             except asyncio.CancelledError:
                 pass
+        if active_generator:
+            active_generator.close()
 
 
 async def main():
@@ -6,14 +6,21 @@
 from pyroute2 import IPRoute
 from bcc import BPF
 import ctypes
+import math
 # import timer
 import time
 import sqlite3 as sql
 import json as js
 from tqdm import tqdm
-from PSUtil import U32ToIpv4,ArrayToIpv6
+from IpAddress import AddressKey,FormatIpv4,FormatIpv6
+from BatchWriter import WriterThread
+from TracerSchema import InitFunctionSchema,StorageBackend
+from RingStore import RingWriter
+from KprobeMulti import TraceableFunctions,AttachKprobeMulti,BPF_TRACE_KPROBE_MULTI
+from RingStats import RingPages,RingCflags,RingStats
 import time
 import os
+import threading
 
 start = 0
 
@@ -33,27 +40,186 @@ SpecList=["icmp_push_reply","rawv6_sendmsg",
         "raw_sendmsg","udp_sendmsg","udpv6_sendmsg","tcp_sendmsg","ip_rcv_core","ip6_rcv_core",
         "ipv6_rcv","ip_rcv","ip_list_rcv","ipv6_list_rcv"
         ]
+# Attached functions as {"name", "mode"}, mode "multi", "fentry" or "kprobe"
 AttachedFuncName=[]
+# Link fds of the kprobe.multi links, closing them detaches every "multi" function
+MultiLinks=[]
 rcvID=[]
 sendID=[]
-g_status=0
+# "auto" attaches the generic functions with two kprobe.multi links (entry and return),
+# what the links cannot take gets the generic kprobe/kretprobe pair function by function.
+# "fentry" uses per-function fentry/fexit trampolines where the kernel supports them (their
+# programs are generated per function), "kprobe" only the generic kprobes
+ProbeMode=os.environ.get("TRACER_PROBE","auto")
+# Kernel symbol table, "address type name [module]"
+KallsymsFile="/proc/kallsyms"
+# What the generic probes do with a call (call_mode in kProberFunc.c): "events" submits every
+# entry and return, "histogram" only adds the call duration to the function's latency histogram
+CallModes={"events":0,"histogram":1}
+CallMode=os.environ.get("TRACER_CALLS","events")
+# FuncID -> name of the generic functions, the ones /SetFuncEnabled switches
+GenericFuncs={}
+# FuncIDs switched off, their bits are clear in func_enabled of kProberFunc.c
+DisabledFuncs=set()
+# Calls/s a function may submit (TRACER_CALL_BUDGET, 0 turns throttling off). Rates are re-read
+# every ThrottleInterval seconds from call_counts, a function over the budget is throttled by
+# ThrottlePolicy: "sample" submits 1 in N of its calls, N = rate/budget rounded up, "count" none,
+# they are only counted. It is released once its rate falls to half the budget.
+ThrottleBudget=float(os.environ.get("TRACER_CALL_BUDGET","0"))
+ThrottlePolicy=os.environ.get("TRACER_THROTTLE","sample")
+ThrottlePolicies=("sample","count")
+ThrottleInterval=1.0
+# THROTTLE_COUNT_ONLY of kProberFunc.c
+ThrottleCountOnly=0xffffffff
+# FuncID -> calls/s over the last interval, FuncID -> N of the throttled functions
+CallRates={}
+Throttled={}
+LastCallCounts={}
+LastThrottleUpdate=0
+# Held while Throttled and func_throttle change, SetThrottle runs on a Flask thread
+ThrottleLock=threading.Lock()
+# LATENCY_SLOTS of kProberFunc.c, slot i counts durations of 2^(i-1) to 2^i-1 ns, the last one everything longer
+LatencySlots=40
+# Pages of the events ring (EVENTS_RING_PAGES of kProberFunc.c), events taken out of it
+EventRingPages=RingPages("TRACER_FUNC_RING_PAGES",512)
+consumed=0
+
+class CallFilter(ctypes.Structure):
+    # Mirror of struct call_filter in kProberFunc.c
+    _fields_=[("enabled",ctypes.c_uint64),
+              ("family",ctypes.c_uint64),
+              ("srcport",ctypes.c_uint64),
+              ("dstport",ctypes.c_uint64),
+              ("srcaddr4",ctypes.c_uint32),
+              ("dstaddr4",ctypes.c_uint32),
+              ("srcaddr6",ctypes.c_uint8*16),
+              ("dstaddr6",ctypes.c_uint8*16)]
+
+g_callfilter=CallFilter()
+
+class DeferredAttachBPF(BPF):
+    # BPF() attaches every kfunc__/kretfunc__ program while loading and the first failure
+    # aborts the whole load. Here nothing is attached on load, each function goes through AttachFunc
+    def _trace_autoload(self):
+        pass
+
+def UseFentry():
+    return ProbeMode=="fentry" and BPF.support_kfunc()
+
+def __KprobeNames(name):
+    # SpecList functions have their own bodies, everything else shares the generic pair
+    if name in SpecList:
+        return "ktprobe_{}".format(name),"ktretprobe_{}".format(name)
+    return "ktgenericprobe","ktgenericretprobe"
+
+def CheckGenericProbes(bpf):
+    # The generic kprobes find the FuncID through bpf_get_func_ip (Linux >= 5.15). Without it
+    # every function would fail on its own, so the prober stops here instead
+    try:
+        bpf.load_func("ktgenericprobe",BPF.KPROBE)
+        bpf.load_func("ktgenericretprobe",BPF.KPROBE)
+    except Exception as e:
+        raise RuntimeError("generic probes cannot be loaded, they need bpf_get_func_ip (Linux >= 5.15): {}".format(e))
+
+def FillFuncIDs(bpf,funcs):
+    # funcs: [(name, FuncID)] -> funcids map of the generic programs, every address of a
+    # name is entered since static functions can share one. Returns the names found
+    wanted=dict(funcs)
+    funcids=bpf["funcids"]
+    found=set()
+    with open(KallsymsFile) as fo:
+        for line in fo:
+            fields=line.split()
+            if len(fields)<3 or fields[1] not in "tT" or fields[2] not in wanted:
+                continue
+            funcids[ctypes.c_uint64(int(fields[0],16))]=ctypes.c_uint64(wanted[fields[2]])
+            found.add(fields[2])
+    return found
+
+def AttachFunc(bpf,name,fentry):
+    # Entry and return probes of one function, returns the mode used, raises if neither attaches
+    if fentry:
+        try:
+            bpf.attach_kfunc(fn_name="kfunc__vmlinux__{}".format(name))
+            try:
+                bpf.attach_kretfunc(fn_name="kretfunc__vmlinux__{}".format(name))
+            except Exception:
+                bpf.detach_kfunc(fn_name="kfunc__vmlinux__{}".format(name))
+                raise
+            return "fentry"
+        except Exception:
+            # Not traceable through a trampoline, e.g. no ftrace entry
+            pass
+    entry,retprobe=__KprobeNames(name)
+    bpf.attach_kprobe(event=name,fn_name=entry)
+    bpf.attach_kretprobe(event=name,fn_name=retprobe)
+    return "kprobe"
+
+def AttachMulti(bpf,funcs):
+    # funcs: [(name, FuncID)]. The traceable ones share the ktmultiprobe/ktmultiretprobe programs,
+    # the FuncID is the link cookie. Returns the names attached, none if the links cannot be created
+    traceable=TraceableFunctions()
+    picked={}
+    for name,funcid in funcs:
+        if name in traceable:
+            picked.setdefault(name,funcid)
+    if not picked:
+        return set()
+    names=list(picked)
+    cookies=[picked[name] for name in names]
+    try:
+        entry=bpf.load_func("ktmultiprobe",BPF.KPROBE,attach_type=BPF_TRACE_KPROBE_MULTI)
+        retprobe=bpf.load_func("ktmultiretprobe",BPF.KPROBE,attach_type=BPF_TRACE_KPROBE_MULTI)
+        links=[AttachKprobeMulti(entry.fd,names,cookies)]
+        try:
+            links.append(AttachKprobeMulti(retprobe.fd,names,cookies,retprobe=True))
+        except Exception:
+            os.close(links[0])
+            raise
+    except Exception as e:
+        # Kernel < 5.18 or a BCC without attach_type, everything goes one by one
+        print("[LOG]kprobe.multi not used: {}".format(e))
+        return set()
+    MultiLinks.extend(links)
+    return set(names)
+
+def DetachFunc(bpf,name,mode):
+    # "multi" functions go with their link, see detachBPFFunc
+    if mode=="multi":
+        return
+    if mode=="fentry":
+        bpf.detach_kfunc(fn_name="kfunc__vmlinux__{}".format(name))
+        bpf.detach_kretfunc(fn_name="kretfunc__vmlinux__{}".format(name))
+    else:
+        entry,retprobe=__KprobeNames(name)
+        bpf.detach_kprobe(event=name,fn_name=entry)
+        bpf.detach_kretprobe(event=name,fn_name=retprobe)
 
 def __init_Func():
     global jsonf
     jsonf=js.load(open("./.cache/relatedFuncD5.json","r"))
-    global database,attachtime
-    database=sql.connect("./.cache/FunctionInfo.db")
-    global cursor
-    cursor=database.cursor()
-    cursor.execute("CREATE TABLE IF NOT EXISTS functionCall(time, isRet, ID ,PID)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS SpecfunctionCall(time, isRet, ID ,PID,family,srcport,dstport,srcip,dstip,pkt)")
+    global attachtime
+    global writer
+    if StorageBackend=="memory":
+        # Only the last rows are kept, in memory, nothing is written under ./.cache
+        writer=RingWriter("./.cache/FunctionInfo.db")
+    else:
+        database=sql.connect("./.cache/FunctionInfo.db")
+        # functionCall/SpecfunctionCall, typed and indexed
+        InitFunctionSchema(database)
+        database.close()
+        # Only the writer thread touches the database from now on
+        writer=WriterThread("./.cache/FunctionInfo.db")
+    writer.start()
     
 
 def detachBPFFunc():
     print("[LOG]End Kprober")
     for item in tqdm(AttachedFuncName):
-        bpfProgSocketCounter.detach_kprobe(event=item["name"],fn_name="ktprobe_{}".format(item["name"]))
-        bpfProgSocketCounter.detach_kretprobe(event=item["name"],fn_name="ktretprobe_{}".format(item["name"]))
+        DetachFunc(bpfProgSocketCounter,item["name"],item["mode"])
+    for fd in MultiLinks:
+        os.close(fd)
+    MultiLinks.clear()
     print("[LOG]Finish Detach Kprobe and Kretprobe")
 
 def buildBPFSocketCounter():
@@ -61,12 +227,16 @@ def buildBPFSocketCounter():
     # socketTracertext=""
     print("[LOG]Begin Build Kprobe and Kretprobe")
     global bpfProgSocketCounter,attachtime,ringbuf
-    bpfProgSocketCounter=BPF(src_file="./.cache/kProberFunc.c")
+    bpfProgSocketCounter=DeferredAttachBPF(src_file="./.cache/kProberFunc.c",cflags=RingCflags(EventRingPages))
+    # kProberFunc.c only has the per-function trampoline programs when translateJSON was told so
+    fentry=UseFentry()
     # https://docs.pyroute2.org/iproute_linux.html
     ringbuf = bpfProgSocketCounter.get_table("events")
     ringbuf.open_ring_buffer(print_event)
+    __ApplyCallMode()
     print("[LOG]Finish Build Kprobe and Kretprobe")
-    for item in tqdm(jsonf):
+    candidates=[]
+    for item in jsonf:
         if item["name"].find("bpf")!=-1 or item["name"] in DisabledList:
             continue
         keywordList=["tcp","udp","icmp","recv","send","xmit","ip","sk","sock"]
@@ -79,32 +249,46 @@ def buildBPFSocketCounter():
             if item["name"] in SpecList:
         # continue
                 rcvID.append(item["id"])
-            # continue
-            try:
-                # if(item["name"]=="tcp_recvmsg"):
-                bpfProgSocketCounter.attach_kprobe(event=item["name"],fn_name="ktprobe_{}".format(item["name"]))
-                bpfProgSocketCounter.attach_kretprobe(event=item["name"],fn_name="ktretprobe_{}".format(item["name"]))
-                AttachedFuncName.append(item["name"])
-                # time.sleep(0.25)
-            except BaseException as e:
-                print(e)
-                continue
-            finally:
-                # if(len(AttachedFuncName)>300):
-                    # break
-                # AttachedFuncName.append(item["name"])
-                pass
+            else:
+                GenericFuncs[item["id"]]=item["name"]
+            candidates.append(item)
+    CheckGenericProbes(bpfProgSocketCounter)
+    # Every function starts enabled, bits must be set before anything is attached
+    __ApplyFuncEnabled()
+    # The generic kprobes find the FuncID by function address
+    FillFuncIDs(bpfProgSocketCounter,[(item["name"],item["id"]) for item in candidates if item["name"] not in SpecList])
+    multi=set()
+    if ProbeMode=="auto":
+        # SpecList bodies read their arguments through pt_regs, they are attached one by one
+        multi=AttachMulti(bpfProgSocketCounter,[(item["name"],item["id"]) for item in candidates
+                                                 if item["name"] not in SpecList])
+    for item in tqdm(candidates):
+        if item["name"] in multi:
+            AttachedFuncName.append({"name":item["name"],"mode":"multi"})
+            continue
+        try:
+            # if(item["name"]=="tcp_recvmsg"):
+            mode=AttachFunc(bpfProgSocketCounter,item["name"],fentry and item["name"] not in SpecList)
+            AttachedFuncName.append({"name":item["name"],"mode":mode})
+            # time.sleep(0.25)
+        except BaseException as e:
+            print(e)
+            continue
     print("[LOG]Finish Attach Kprobe and Kretprobe")
     print(rcvID)
     # print(AttachedFuncName)
     print(len(AttachedFuncName))
+    print("[LOG]kprobe.multi: {} fentry/fexit: {}".format(len(multi),
+          sum(1 for item in AttachedFuncName if item["mode"]=="fentry")))
     attachtime=time.time()
+    global LastThrottleUpdate
+    LastThrottleUpdate=attachtime
 
 
 
 def print_event(cpu,data,size):
-    global start
-    global g_status
+    global start,consumed
+    consumed+=1
     # print(2)
     event = bpfProgSocketCounter["events"].event(data)
     pid=event.pid
@@ -116,33 +300,26 @@ def print_event(cpu,data,size):
     pid=event.pid
     if id >= 200000 and ret == 0:
         if id >=300000:
-            cursor.execute("INSERT INTO functionCall VALUES(?,?,?,?)",(attachtime+time_s,ret,id,pid))
-            cursor.execute("INSERT INTO SpecfunctionCall VALUES(?,?,?,?,?,?,?,?,?,?)",(attachtime+time_s,ret,id,pid,0,0,0,"","",""))
+            writer.insert("functionCall",(attachtime+time_s,ret,id,pid))
+            writer.insert("SpecfunctionCall",(attachtime+time_s,ret,id,pid,0,0,0,"","",""))
             # Always Needed
             return
         family=event.family
         dport=event.dport
         lport=event.lport
         if lport>65536 or dport>65536:
-            cursor.execute("INSERT INTO functionCall VALUES(?,?,?,?)",(attachtime+time_s,ret,id,pid))
+            writer.insert("functionCall",(attachtime+time_s,ret,id,pid))
             return
-        dstip=""
-        srcip=""
+        # Text comes from the per-address cache
         if family==4:
-            dstip=U32ToIpv4(event.ipv4__recvaddr)
-            srcip=U32ToIpv4(event.ipv4__sendaddr)
+            dstip=FormatIpv4(event.ipv4__recvaddr)
+            srcip=FormatIpv4(event.ipv4__sendaddr)
         elif family==6:
-            dstip=ArrayToIpv6(event.ipv6__recvaddr)
-            srcip=ArrayToIpv6(event.ipv6__sendaddr)
+            dstip=FormatIpv6(int.from_bytes(event.ipv6__recvaddr,"big"))
+            srcip=FormatIpv6(int.from_bytes(event.ipv6__sendaddr,"big"))
         else:
-            cursor.execute("INSERT INTO functionCall VALUES(?,?,?,?)",(attachtime+time_s,ret,id,pid))
+            writer.insert("functionCall",(attachtime+time_s,ret,id,pid))
             return
-        if (srcip==g_srcip and dstip==g_dstip) or (srcip==g_dstip and dstip==g_srcip):
-            if (lport==g_srcport and dport==g_dstport) or (lport==g_dstport and dport==g_srcport):
-                if ret==0:
-                    g_status+=1
-                elif ret==1 and g_status>0:
-                    g_status-=1
         # else:
             # dstip=""
             # srcip=""
@@ -150,21 +327,195 @@ def print_event(cpu,data,size):
             # print("No family?")
             # cursor.execute("INSERT INTO functionCall VALUES(?,?,?,?)",(attachtime+time_s,ret,id,pid))
             # return
-        cursor.execute("INSERT INTO SpecfunctionCall VALUES(?,?,?,?,?,?,?,?,?,?)",(attachtime+time_s,ret,id,pid,family,lport,dport,srcip,dstip,""))
-        cursor.execute("INSERT INTO functionCall VALUES(?,?,?,?)",(attachtime+time_s,ret,id,pid))
+        writer.insert("SpecfunctionCall",(attachtime+time_s,ret,id,pid,family,lport,dport,srcip,dstip,""))
+        writer.insert("functionCall",(attachtime+time_s,ret,id,pid))
         return
     if id >= 200000 and ret == 1:
-        cursor.execute("INSERT INTO functionCall VALUES(?,?,?,?)",(attachtime+time_s,ret,id,pid))
+        writer.insert("functionCall",(attachtime+time_s,ret,id,pid))
         return
     # if id in sendID:
     #     continue
-    # TODO Filter Data Storage -> Use Pid
-    if g_status>0 or (g_srcport<0):
-        cursor.execute("INSERT INTO functionCall VALUES(?,?,?,?)",(attachtime+time_s,ret,id,pid))
+    # Generic calls outside the filtered flow are dropped in the kernel (flow_active in kProberFunc.c)
+    writer.insert("functionCall",(attachtime+time_s,ret,id,pid))
     return 
         # TODO Data Tramsmission
 
 
+def SetFlowFilter(srcip,dstip,srcport,dstport):
+    # Flow whose calls are kept, addresses in the integer form of the events.
+    # Anything that is not an address matches no event, port < 0 keeps every call
+    newfilter=CallFilter()
+    newfilter.enabled=int(srcport)>=0
+    newfilter.srcport=int(srcport)&0xffffffffffffffff
+    newfilter.dstport=int(dstport)&0xffffffffffffffff
+    try:
+        family,srckey=AddressKey(srcip)
+        dstfamily,dstkey=AddressKey(dstip)
+    except (OSError,TypeError):
+        family,dstfamily=0,None
+    if family==dstfamily==4:
+        newfilter.family=4
+        newfilter.srcaddr4=srckey
+        newfilter.dstaddr4=dstkey
+    elif family==dstfamily==6:
+        newfilter.family=6
+        ctypes.memmove(newfilter.srcaddr6,srckey.to_bytes(16,"big"),16)
+        ctypes.memmove(newfilter.dstaddr6,dstkey.to_bytes(16,"big"),16)
+    global g_callfilter
+    g_callfilter=newfilter
+    __ApplyFlowFilter()
+
+def __ApplyFlowFilter():
+    # Filter may be set before the probes are built, it's applied again after build.
+    # Threads marked under the previous filter are forgotten
+    if "bpfProgSocketCounter" not in globals():
+        return
+    table=bpfProgSocketCounter["call_filter"]
+    table[table.Key(0)]=g_callfilter
+    bpfProgSocketCounter["flow_threads"].clear()
+
+def UnsetFlowFilter():
+    SetFlowFilter("","",-1,-1)
+
+def SetCallMode(mode):
+    # Raises ValueError for a mode not in CallModes
+    if mode not in CallModes:
+        raise ValueError("call mode must be one of {}".format(",".join(CallModes)))
+    global CallMode
+    CallMode=mode
+    __ApplyCallMode()
+
+def __ApplyCallMode():
+    if "bpfProgSocketCounter" not in globals():
+        return
+    table=bpfProgSocketCounter["call_mode"]
+    table[table.Key(0)]=table.Leaf(CallModes[CallMode])
+
+def SelectFuncs(funcs=(),keyword=""):
+    # FuncIDs of the generic functions given by FuncID or name, and of every one whose name contains keyword
+    byname={name:funcid for funcid,name in GenericFuncs.items()}
+    selected=set()
+    for item in funcs:
+        item=str(item).strip()
+        if item.isdigit() and int(item) in GenericFuncs:
+            selected.add(int(item))
+        elif item in byname:
+            selected.add(byname[item])
+        elif item:
+            raise ValueError("{} is not a traced generic function".format(item))
+    if keyword:
+        selected.update(funcid for funcid,name in GenericFuncs.items() if keyword in name)
+    return selected
+
+def SetFuncsEnabled(funcids,enabled):
+    # Takes effect on the next call, nothing is detached
+    if enabled:
+        DisabledFuncs.difference_update(funcids)
+    else:
+        DisabledFuncs.update(funcids)
+    __ApplyFuncEnabled({funcid>>6 for funcid in funcids})
+
+def GetDisabledFuncs():
+    return [{"FuncID":funcid,"name":GenericFuncs.get(funcid,"")} for funcid in sorted(DisabledFuncs)]
+
+def __ApplyFuncEnabled(words=None):
+    # Rewrite the given 64 bit words of func_enabled, every word when None
+    if "bpfProgSocketCounter" not in globals():
+        return
+    table=bpfProgSocketCounter["func_enabled"]
+    cleared={}
+    for funcid in DisabledFuncs:
+        cleared[funcid>>6]=cleared.get(funcid>>6,0)|(1<<(funcid&63))
+    for word in range(len(table)) if words is None else words:
+        if word<len(table):
+            table[table.Key(word)]=table.Leaf(((1<<64)-1)&~cleared.get(word,0))
+
+def __ThrottleFor(funcid,rate):
+    # N for the function at this rate, None when it goes unthrottled
+    if ThrottleBudget<=0:
+        return None
+    if rate<=(ThrottleBudget/2 if funcid in Throttled else ThrottleBudget):
+        return None
+    if ThrottlePolicy=="count":
+        return ThrottleCountOnly
+    return max(math.ceil(rate/ThrottleBudget),2)
+
+def UpdateThrottle():
+    # Called from the poll loop, does nothing until ThrottleInterval has passed
+    global LastCallCounts,LastThrottleUpdate
+    now=time.time()
+    elapsed=now-LastThrottleUpdate
+    if elapsed<ThrottleInterval:
+        return
+    LastThrottleUpdate=now
+    counts={key.value:sum(percpu) for key,percpu in bpfProgSocketCounter["call_counts"].items()}
+    table=bpfProgSocketCounter["func_throttle"]
+    with ThrottleLock:
+        for funcid,count in counts.items():
+            rate=(count-LastCallCounts.get(funcid,0))/elapsed
+            CallRates[funcid]=rate
+            sample=__ThrottleFor(funcid,rate)
+            if sample==Throttled.get(funcid):
+                continue
+            if sample is None:
+                del Throttled[funcid]
+                del table[table.Key(funcid)]
+            else:
+                Throttled[funcid]=sample
+                table[table.Key(funcid)]=table.Leaf(sample)
+    LastCallCounts=counts
+
+def SetThrottle(budget,policy):
+    # Raises ValueError for a policy not in ThrottlePolicies, throttles are worked out again from the next rates
+    if policy not in ThrottlePolicies:
+        raise ValueError("policy must be one of {}".format(",".join(ThrottlePolicies)))
+    global ThrottleBudget,ThrottlePolicy
+    budget=float(budget)
+    with ThrottleLock:
+        ThrottleBudget=budget
+        ThrottlePolicy=policy
+        Throttled.clear()
+        if "bpfProgSocketCounter" in globals():
+            bpfProgSocketCounter["func_throttle"].clear()
+
+def GetThrottleState(top=10):
+    # Settings, throttled functions ("sample" None when only counted) and the top call rates
+    def describe(funcid):
+        return {"FuncID":funcid,"name":GenericFuncs.get(funcid,""),"rate":round(CallRates.get(funcid,0),1)}
+    throttled=[]
+    for funcid,sample in sorted(list(Throttled.items())):
+        item=describe(funcid)
+        item["sample"]=None if sample==ThrottleCountOnly else sample
+        throttled.append(item)
+    hottest=sorted(list(CallRates.items()),key=lambda item:item[1],reverse=True)[:top]
+    return {"budget":ThrottleBudget,"policy":ThrottlePolicy,"interval":ThrottleInterval,
+            "throttled":throttled,"top":[describe(funcid) for funcid,rate in hottest]}
+
+def GetFuncLatency():
+    # Latency histograms summed over the CPUs, most called function first:
+    # [{"FuncID", "name", "calls", "hist": [[low ns, high ns, count], ...]}], empty slots left out
+    if "bpfProgSocketCounter" not in globals():
+        return []
+    names={item["id"]:item["name"] for item in jsonf}
+    result=[]
+    for key,percpu in bpfProgSocketCounter["call_latency"].items():
+        hist=[]
+        for slot in range(LatencySlots):
+            count=sum(value.slots[slot] for value in percpu)
+            if count:
+                high=(1<<slot)-1 if slot<LatencySlots-1 else None
+                hist.append([(1<<slot)>>1,high,count])
+        result.append({"FuncID":key.value,"name":names.get(key.value,""),
+                       "calls":sum(value.calls for value in percpu),"hist":hist})
+    result.sort(key=lambda item:item["calls"],reverse=True)
+    return result
+
+def GetRingStats():
+    # None until the prober is built
+    if "bpfProgSocketCounter" not in globals():
+        return None
+    return RingStats(bpfProgSocketCounter,EventRingPages,consumed,writer)
+
 def AttachAndRunProbers(event):
     event.wait()
     __init_Func()
@@ -173,18 +524,10 @@ def AttachAndRunProbers(event):
     buildBPFSocketCounter()
     global clear_flag_func
     clear_flag_func = False
-    global g_status
-    g_status=0
-    global g_srcport,g_dstport,g_srcip,g_dstip
-    
-    g_srcip=""
-    g_dstip=""
-    g_srcport=-1
-    g_dstport=-1
+    UnsetFlowFilter()
     # ringbuf = bpfTcxTracer.get_table("events")
     # ringbuf = bpfProgSocketCounter.get_table("events")
     # ringbuf.open_ring_buffer(print_event)
-    starttime=time.time()
     is_attach_finished=True
     # tid=os.getpid()
     # process = psutil.Process(tid)
@@ -192,18 +535,16 @@ def AttachAndRunProbers(event):
     # print(open_files)
     while True:
         try:
-            if(time.time()-starttime>1):
-                starttime=time.time()
-                database.commit()
-                if clear_flag_func:
-                    cursor.execute("DELETE FROM functionCall WHERE time < {}".format(starttime))
-                    cursor.execute("DELETE FROM SpecfunctionCall WHERE time < {}".format(starttime))
-                    # database.commit()
-                    clear_flag_func=False
-                database.commit()
-            # Not Commit TOO many times
+            if clear_flag_func:
+                # DELETE runs on the writer thread, polling goes on meanwhile
+                writer.request_clear(["functionCall","SpecfunctionCall"])
+                bpfProgSocketCounter["call_latency"].clear()
+                clear_flag_func=False
             # print(1)
-            bpfProgSocketCounter.ring_buffer_poll()
+            bpfProgSocketCounter.ring_buffer_poll(int(writer.maxdelay*1000))
+            # Hand rows of this poll to the writer, never waits for disk
+            writer.submit()
+            UpdateThrottle()
         except KeyboardInterrupt:
             break
         finally:
@@ -219,19 +560,15 @@ if __name__ == "__main__":
     # ringbuf = bpfTcxTracer.get_table("events")
     # ringbuf = bpfProgSocketCounter.get_table("events")
     # ringbuf.open_ring_buffer(print_event)
-    starttime=time.time()
     # tid=os.getpid()
     # process = psutil.Process(tid)
     # open_files = process.open_files()
     # print(open_files)
     while True:
         try:
-            if(time.time()-starttime>1):
-                starttime=time.time()
-                database.commit()
-            # Not Commit TOO many times
             # print(1)
-            bpfProgSocketCounter.ring_buffer_poll()
+            bpfProgSocketCounter.ring_buffer_poll(int(writer.maxdelay*1000))
+            writer.submit()
         except KeyboardInterrupt:
             break
         finally:
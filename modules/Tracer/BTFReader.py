@@ -0,0 +1,127 @@
+import struct
+from array import array
+
+# Reader of the raw BTF blob of /sys/kernel/btf/vmlinux, replacing the bpftool JSON dump that
+# needed the whole type graph as Python dicts (gigabytes for a vmlinux). Types are read one by
+# one out of the type section and only what the sk_buff analysis needs is kept, in flat arrays
+# indexed by type id: kind, name offset, referenced type, and the member (STRUCT/UNION) or
+# parameter (FUNC_PROTO) types of every type, CSR style. Names stay in the string section.
+
+BTF_MAGIC=0xeB9F
+HeaderFormat="<HBBIIIII"
+TypeFormat="<III"
+TypeSize=12
+
+# BTF_KIND_* numbers, "" for unused numbers
+KindNames=("UNKN","INT","PTR","ARRAY","STRUCT","UNION","ENUM","FWD","TYPEDEF","VOLATILE","CONST","RESTRICT",
+           "FUNC","FUNC_PROTO","VAR","DATASEC","FLOAT","DECL_TAG","TYPE_TAG","ENUM64")
+KindNumbers={name:number for number,name in enumerate(KindNames)}
+# FUNC linkage, kept in vlen
+LinkageNames=("static","global","extern")
+
+def __ExtraSize(kind,vlen):
+    # Bytes following struct btf_type for a kind
+    if kind==KindNumbers["INT"] or kind==KindNumbers["VAR"] or kind==KindNumbers["DECL_TAG"]:
+        return 4
+    if kind==KindNumbers["ARRAY"]:
+        return 12
+    if kind==KindNumbers["STRUCT"] or kind==KindNumbers["UNION"] or kind==KindNumbers["DATASEC"] \
+        or kind==KindNumbers["ENUM64"]:
+        return vlen*12
+    if kind==KindNumbers["ENUM"] or kind==KindNumbers["FUNC_PROTO"]:
+        return vlen*8
+    if kind<len(KindNames):
+        return 0
+    raise ValueError("unknown BTF kind {}".format(kind))
+
+class BTFTypes:
+    # Type id 0 is void, ids follow the order of the type section
+    def __init__(self):
+        self.kind=array("B",[0])
+        self.nameoff=array("I",[0])
+        self.typeid=array("I",[0])
+        self.vlen=array("H",[0])
+        self.refstart=array("I",[0,0])
+        self.refs=array("I")
+        self.strings=b"\0"
+
+    def __len__(self):
+        return len(self.kind)
+
+    def add(self,kind,nameoff,typeid,vlen,refs=()):
+        self.kind.append(kind)
+        self.nameoff.append(nameoff)
+        self.typeid.append(typeid)
+        self.vlen.append(vlen)
+        self.refs.extend(refs)
+        self.refstart.append(len(self.refs))
+
+    def name(self,typeid):
+        start=self.nameoff[typeid]
+        end=self.strings.index(b"\0",start)
+        return self.strings[start:end].decode() or "(anon)"
+
+    def members(self,typeid):
+        # Member or parameter type ids
+        return self.refs[self.refstart[typeid]:self.refstart[typeid+1]]
+
+    def find(self,name,kind):
+        # First type id of that kind and name, None if there is none
+        target=name.encode()
+        number=KindNumbers[kind]
+        for typeid in range(1,len(self.kind)):
+            if self.kind[typeid]==number and self.strings.startswith(target+b"\0",self.nameoff[typeid]):
+                return typeid
+        return None
+
+def ReadRawBTF(path):
+    # Raises ValueError when the file is not BTF
+    with open(path,"rb") as fo:
+        data=fo.read()
+    if len(data)<struct.calcsize(HeaderFormat):
+        raise ValueError("{} is too short for BTF".format(path))
+    magic,version,flags,hdrlen,typeoff,typelen,stroff,strlen=struct.unpack_from(HeaderFormat,data)
+    if magic!=BTF_MAGIC:
+        raise ValueError("{} is not BTF".format(path))
+    btf=BTFTypes()
+    btf.strings=data[hdrlen+stroff:hdrlen+stroff+strlen]
+    offset=hdrlen+typeoff
+    end=offset+typelen
+    while offset<end:
+        nameoff,info,sizetype=struct.unpack_from(TypeFormat,data,offset)
+        kind=(info>>24)&0x1f
+        vlen=info&0xffff
+        body=offset+TypeSize
+        refs=()
+        if kind==KindNumbers["ARRAY"]:
+            # Element type, struct btf_array follows
+            sizetype=struct.unpack_from("<I",data,body)[0]
+        elif kind==KindNumbers["STRUCT"] or kind==KindNumbers["UNION"]:
+            # struct btf_member: name_off, type, offset
+            refs=struct.unpack_from("<{}I".format(vlen*3),data,body)[1::3]
+        elif kind==KindNumbers["FUNC_PROTO"]:
+            # struct btf_param: name_off, type
+            refs=struct.unpack_from("<{}I".format(vlen*2),data,body)[1::2]
+        btf.add(kind,nameoff,sizetype,vlen,refs)
+        offset=body+__ExtraSize(kind,vlen)
+    if offset!=end:
+        raise ValueError("{}: type section overrun".format(path))
+    return btf
+
+def FromDump(types):
+    # Same arrays from the types of a bpftool -j btf dump, listed by id
+    btf=BTFTypes()
+    names=bytearray(b"\0")
+    for item in types:
+        nameoff=len(names)
+        names+=("" if item["name"]=="(anon)" else item["name"]).encode()+b"\0"
+        kind=item["kind"]
+        refs=()
+        if kind=="STRUCT" or kind=="UNION":
+            refs=[member["type_id"] for member in item["members"]]
+        elif kind=="FUNC_PROTO":
+            refs=[para["type_id"] for para in item["params"]]
+        vlen=LinkageNames.index(item["linkage"]) if kind=="FUNC" else len(refs)
+        btf.add(KindNumbers.get(kind,0),nameoff,item.get("type_id",0),vlen,refs)
+    btf.strings=bytes(names)
+    return btf
@@ -0,0 +1,244 @@
+import time
+import queue
+import threading
+import sqlite3 as sql
+from itertools import islice
+from TracerSchema import ConfigureWriter,ListBuckets,CreateBucket,BucketOf,BucketTable,BucketSeconds
+
+# Flush when this many rows are staged, or when the oldest staged row is this old
+DefaultMaxRows=10000
+DefaultMaxDelay=0.2
+# Poll thread hands rows over in chunks, at most this many chunks wait for the writer
+DefaultChunkRows=1024
+DefaultMaxChunks=256
+# Seconds between PASSIVE WAL checkpoints, they never wait for readers
+DefaultCheckpointInterval=1.0
+# Retention: drop time buckets older than maxage seconds, then the oldest ones
+# while the live data is above maxbytes; checked every retentioninterval seconds
+DefaultMaxAge=3600.0
+DefaultMaxBytes=2*1024*1024*1024
+DefaultRetentionInterval=5.0
+
+class BatchWriter:
+    # Stage decoded rows per table in preallocated lists, then write each
+    # time bucket with executemany and commit the whole batch at once
+    def __init__(self,database,maxrows=DefaultMaxRows,maxdelay=DefaultMaxDelay):
+        self.database=database
+        self.cursor=database.cursor()
+        self.maxrows=maxrows
+        self.maxdelay=maxdelay
+        # table -> [rows, count]
+        self.batches={}
+        # bucket table -> insert statement, for the buckets this writer has created
+        self.statements={}
+        self.pending=0
+        # Rows committed so far
+        self.written=0
+        self.lastflush=time.time()
+
+    def insert(self,table,row):
+        batch=self.batches.get(table)
+        if batch is None:
+            batch=[[None]*self.maxrows,0]
+            self.batches[table]=batch
+        batch[0][batch[1]]=row
+        batch[1]+=1
+        self.pending+=1
+        if batch[1]>=self.maxrows:
+            self.flush()
+
+    def maybe_flush(self):
+        if self.pending==0:
+            self.lastflush=time.time()
+            return
+        if self.pending>=self.maxrows or time.time()-self.lastflush>=self.maxdelay:
+            self.flush()
+
+    def bucket_statement(self,table,bucket,width):
+        name=BucketTable(table,bucket)
+        statement=self.statements.get(name)
+        if statement is None:
+            CreateBucket(self.database,table,bucket)
+            statement="INSERT INTO {} VALUES({})".format(name,",".join("?"*width))
+            self.statements[name]=statement
+        return statement
+
+    def forget(self,names):
+        # Bucket tables dropped behind our back are created again on their next row
+        for name in names:
+            self.statements.pop(name,None)
+
+    def flush(self):
+        if self.pending>0:
+            for table,batch in self.batches.items():
+                rows,count=batch
+                start=0
+                while start<count:
+                    # Rows come nearly in time order, write each run of one bucket at once
+                    bucket=BucketOf(rows[start][0])
+                    low=bucket*BucketSeconds
+                    high=low+BucketSeconds
+                    end=start+1
+                    while end<count and low<=rows[end][0]<high:
+                        end+=1
+                    self.cursor.executemany(self.bucket_statement(table,bucket,len(rows[start])),islice(rows,start,end))
+                    start=end
+                batch[1]=0
+            self.database.commit()
+            self.written+=self.pending
+            self.pending=0
+        self.lastflush=time.time()
+
+    def discard(self):
+        # After a failed write: roll back, forget staged rows and the bucket tables the
+        # rollback may have taken along, returns the number of rows lost
+        self.database.rollback()
+        self.statements={}
+        lost=self.pending
+        for batch in self.batches.values():
+            batch[1]=0
+        self.pending=0
+        self.lastflush=time.time()
+        return lost
+
+
+class WriterThread(threading.Thread):
+    # Own the SQLite connection so the ring buffer poll thread never touches disk.
+    # insert/insert_batch/submit/request_clear are called from the poll thread and never block:
+    # when the bounded queue is full the chunk is dropped and counted in dropped.
+    # A database error loses the rows staged for that write (counted in failed), the thread goes on.
+    def __init__(self,dbpath,maxrows=DefaultMaxRows,maxdelay=DefaultMaxDelay,
+                 chunkrows=DefaultChunkRows,maxchunks=DefaultMaxChunks,checkpointinterval=DefaultCheckpointInterval,
+                 maxage=DefaultMaxAge,maxbytes=DefaultMaxBytes,retentioninterval=DefaultRetentionInterval):
+        threading.Thread.__init__(self,daemon=True)
+        self.dbpath=dbpath
+        self.maxrows=maxrows
+        self.maxdelay=maxdelay
+        self.chunkrows=chunkrows
+        self.checkpointinterval=checkpointinterval
+        self.maxage=maxage
+        self.maxbytes=maxbytes
+        self.retentioninterval=retentioninterval
+        self.queue=queue.Queue(maxchunks)
+        self.chunk=[]
+        self.dropped=0
+        self.failed=0
+        self.written=0
+        # WAL frames left behind by the last checkpoint, readers still holding an older snapshot
+        self.walbacklog=0
+        # (tables, cutoff time) set by request_clear, handled on the writer thread
+        self.clearrequest=None
+        self.cutoff=0
+
+    def insert(self,table,row):
+        self.chunk.append((table,row))
+        if len(self.chunk)>=self.chunkrows:
+            self.submit()
+
+    def insert_batch(self,batch):
+        # batch: sized iterable of (table, row) pairs, only iterated on the writer thread
+        self.submit()
+        self.chunk=batch
+        self.submit()
+
+    def submit(self):
+        if not self.chunk:
+            return
+        try:
+            self.queue.put_nowait(self.chunk)
+        except queue.Full:
+            self.dropped+=len(self.chunk)
+        self.chunk=[]
+
+    def request_clear(self,tables):
+        # Delete every row older than now, including rows still waiting in the queue
+        self.clearrequest=(tables,time.time())
+
+    def checkpoint(self,database):
+        # (busy, frames in WAL, frames copied back), busy is never set in PASSIVE mode
+        busy,walframes,copied=database.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        self.walbacklog=max(walframes-copied,0)
+
+    def drop_buckets(self,database,batch,names):
+        for name in names:
+            database.execute("DROP TABLE IF EXISTS {}".format(name))
+        batch.forget(names)
+        database.commit()
+
+    def vacuum(self,database):
+        # Hand the pages of dropped buckets back to the file system, the WAL shrinks at the next checkpoint.
+        # execute() would step the pragma only once (one page), executescript() runs it to completion
+        database.executescript("PRAGMA incremental_vacuum")
+
+    def used_bytes(self,database):
+        pagesize=database.execute("PRAGMA page_size").fetchone()[0]
+        pages=database.execute("PRAGMA page_count").fetchone()[0]
+        free=database.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages-free)*pagesize
+
+    def enforce_retention(self,database,batch):
+        buckets=ListBuckets(database)
+        if not buckets:
+            return
+        expired=BucketOf(time.time()-self.maxage)
+        self.drop_buckets(database,batch,[name for bucket,_,name in buckets if bucket<expired])
+        # Oldest first while over maxbytes, the newest bucket is always kept
+        remain=sorted(set(bucket for bucket,_,_ in buckets if bucket>=expired))
+        for oldest in remain[:-1]:
+            if self.used_bytes(database)<=self.maxbytes:
+                break
+            self.drop_buckets(database,batch,[name for bucket,_,name in buckets if bucket==oldest])
+        self.vacuum(database)
+
+    def clear(self,database,batch,tables,cutoff):
+        # Whole buckets before cutoff are dropped, only the bucket holding cutoff needs a DELETE
+        drop=[]
+        for bucket,table,name in ListBuckets(database):
+            if table not in tables:
+                continue
+            if (bucket+1)*BucketSeconds<=cutoff:
+                drop.append(name)
+            elif bucket*BucketSeconds<cutoff:
+                database.execute("DELETE FROM {} WHERE time < ?".format(name),(cutoff,))
+        self.drop_buckets(database,batch,drop)
+        self.vacuum(database)
+
+    def run(self):
+        database=sql.connect(self.dbpath)
+        ConfigureWriter(database)
+        batch=BatchWriter(database,self.maxrows,self.maxdelay)
+        lastcheckpoint=time.time()
+        lastretention=0
+        while True:
+            try:
+                chunk=self.queue.get(timeout=self.maxdelay)
+            except queue.Empty:
+                chunk=None
+            # Rows of chunk not handed to batch yet
+            left=0
+            try:
+                if self.clearrequest is not None:
+                    tables,self.cutoff=self.clearrequest
+                    self.clearrequest=None
+                    batch.flush()
+                    self.clear(database,batch,tables,self.cutoff)
+                if chunk is not None:
+                    cutoff=self.cutoff
+                    left=len(chunk)
+                    for table,row in chunk:
+                        left-=1
+                        # Row time is always the first column
+                        if row[0]>=cutoff:
+                            batch.insert(table,row)
+                batch.maybe_flush()
+                # Checkpoint between batches, so it only competes with readers and not with inserts
+                if batch.pending==0 and time.time()-lastcheckpoint>=self.checkpointinterval:
+                    self.checkpoint(database)
+                    lastcheckpoint=time.time()
+                if batch.pending==0 and time.time()-lastretention>=self.retentioninterval:
+                    self.enforce_retention(database,batch)
+                    lastretention=time.time()
+            except sql.Error as e:
+                print("[LOG]Writer of {}: {}".format(self.dbpath,e))
+                self.failed+=batch.discard()+left
+            self.written=batch.written
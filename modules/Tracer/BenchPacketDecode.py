@@ -0,0 +1,144 @@
+import ctypes
+import random
+import struct
+import sys
+import time
+from PacketDecoder import DecodeRecords,CopyRecord,MetadataSize
+from IpAddress import PackAddress
+
+# Cost per packet of the tcx records: the old per-record decode in print_event against
+# copying each record and decoding the whole poll with PacketDecoder. "capture" is what
+# runs on the ring buffer poll thread, "writer" the rows built later on WriterThread.
+# Usage: python BenchPacketDecode.py [records per poll]
+
+Records=int(sys.argv[1]) if len(sys.argv)>1 else 4096
+Repeat=20
+# Records are reserved with the size of their snap class, "full" by default
+RecordSize=MetadataSize+6144
+
+def __Ipv4Packet(length,prot):
+    ihl=random.choice([5,5,5,6])
+    header=bytes([0x40|ihl,0])+struct.pack(">HHH",length,random.randint(0,65535),0x4000)+bytes([64,prot,0,0])
+    header+=bytes(random.randint(0,255) for i in range(8))+b"\x01\x02\x03\x04"*(ihl-5)
+    return header+struct.pack(">HH",random.randint(1,65535),random.randint(1,65535))
+
+def __Ipv6Packet(prot):
+    header=b"\x60\x00\x00\x00"+struct.pack(">H",40)+bytes([prot,64])
+    header+=bytes(random.randint(0,255) for i in range(32))
+    return header+struct.pack(">HH",random.randint(1,65535),random.randint(1,65535))
+
+def __Record(i):
+    # struct packet_metadata followed by the captured bytes
+    kind=random.random()
+    if kind<0.6:
+        ethertype,body=0x0800,__Ipv4Packet(1400,random.choice([6,6,17,1]))
+    elif kind<0.9:
+        ethertype,body=0x86dd,__Ipv6Packet(random.choice([6,17,58]))
+    else:
+        ethertype,body=0x0806,b"\x00"*28
+    frame=b"\x11"*12+struct.pack(">H",ethertype)+body
+    frame+=bytes(random.randint(60,1400)-len(frame)%60)
+    return struct.pack("<QQQQQ",i&1,1000000000+i*1000,2,len(frame),len(frame))+frame
+
+def __ArrayToIpv4(input):
+    # Old PSUtil formatters, as print_event used them
+    return str(input[0])+"."+str(input[1])+"."+str(input[2])+"."+str(input[3])
+
+def __ArrayToIpv6(input):
+    strM=""
+    for i in range(16):
+        t=hex(input[i])[2:]
+        if len(t)==1:
+            t="0"+t
+        strM+=t
+        if i%2==1 and i!=15:
+            strM+=":"
+    return strM
+
+def __LegacyDecode(data,size,rows):
+    # Body of the old print_event, start fixed at 0
+    header=(ctypes.c_uint64*5).from_address(data)
+    time_s=float(header[1])/1000000000
+    payloadlen=header[3]
+    caplen=min(header[4],size-MetadataSize)
+    payload=ctypes.string_at(data+MetadataSize,caplen)
+    direction=header[0]
+    if caplen<14:
+        rows.append(("otherpackets",(time_s,0,direction,payloadlen,payload)))
+        return
+    ethernetType=payload[12]*256+payload[13]
+    if ethernetType != 0x0800 and ethernetType != 0x86dd:
+        rows.append(("otherpackets",(time_s,0,direction,payloadlen,payload)))
+        return
+    prottype=payload[14]&0xf0
+    if prottype == 64 and caplen>=34:
+        srcip=__ArrayToIpv4(payload[26:30])
+        dstip=__ArrayToIpv4(payload[30:34])
+        nextprotstart=(payload[14]&0x0f)*4+14
+        subprot=payload[23]
+        ttl=payload[22]
+        ipid=payload[19]+payload[18]*256
+        if subprot == 17 or subprot == 6:
+            srcport=0
+            dstport=0
+            if caplen>=nextprotstart+4:
+                srcport=payload[nextprotstart+1]+payload[nextprotstart]*256
+                dstport=payload[nextprotstart+3]+payload[nextprotstart+2]*256
+            rows.append(("ipv4packets",(time_s,0,direction,payloadlen,payload,srcip,dstip,srcport,dstport,
+                                        subprot,ipid,ttl,payload[20:22],payload[34:nextprotstart])))
+        elif subprot == 1:
+            rows.append(("ipv4packets",(time_s,0,direction,payloadlen,payload,srcip,dstip,0,0,
+                                        subprot,ipid,ttl,payload[20:22],payload[34:nextprotstart])))
+        else:
+            rows.append(("otherpackets",(time_s,0,direction,payloadlen,payload)))
+    elif prottype==96 and caplen>=58:
+        headertype=payload[20]
+        srcip=__ArrayToIpv6(payload[22:38])
+        dstip=__ArrayToIpv6(payload[38:54])
+        if headertype == 6 or headertype == 17:
+            srcport=payload[55]+payload[54]*256
+            # The old code read this one byte swapped, compare against network order
+            dstport=payload[57]+payload[56]*256
+            rows.append(("ipv6packets",(time_s,0,direction,payloadlen,payload,srcip,dstip,headertype,srcport,dstport)))
+        elif headertype == 58:
+            rows.append(("ipv6packets",(time_s,0,direction,payloadlen,payload,srcip,dstip,headertype,0,0)))
+        else:
+            rows.append(("otherpackets",(time_s,0,direction,payloadlen,payload)))
+    else:
+        rows.append(("otherpackets",(time_s,0,direction,payloadlen,payload)))
+
+def __Capture(buffers):
+    # print_event only copies the captured bytes, DecodePending decodes the poll
+    pending=[]
+    for buffer in buffers:
+        pending.append(CopyRecord(ctypes.addressof(buffer),RecordSize))
+    return DecodeRecords(pending,0,0)
+
+def __Legacy(buffers):
+    rows=[]
+    for buffer in buffers:
+        __LegacyDecode(ctypes.addressof(buffer),RecordSize,rows)
+    return rows
+
+def __Measure(decode,buffers):
+    cost=[]
+    for i in range(Repeat):
+        begin=time.perf_counter()
+        decode(buffers)
+        cost.append(time.perf_counter()-begin)
+    cost.sort()
+    return cost[len(cost)//2]/len(buffers)*1e9
+
+if __name__ == "__main__":
+    random.seed(0)
+    buffers=[ctypes.create_string_buffer(record,RecordSize) for record in (__Record(i) for i in range(Records))]
+    # Same rows once the legacy text addresses are packed
+    packed=[(table,row[:5]+(PackAddress(row[5]),PackAddress(row[6]))+row[7:] if table!="otherpackets" else row)
+            for table,row in __Legacy(buffers)]
+    print("same rows:",list(__Capture(buffers))==packed)
+    legacy=__Measure(__Legacy,buffers)
+    capture=__Measure(__Capture,buffers)
+    batches=[__Capture(buffers) for i in range(Repeat)]
+    writer=__Measure(lambda buffers:list(batches.pop()),buffers)
+    print("records={} legacy={:.0f}ns/pkt capture={:.0f}ns/pkt ({:.1f}x) writer={:.0f}ns/pkt total={:.1f}x".format(
+        Records,legacy,capture,legacy/capture,writer,legacy/(capture+writer)))
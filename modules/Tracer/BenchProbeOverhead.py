@@ -0,0 +1,111 @@
+import socket
+import sys
+import threading
+import time
+from bcc import BPF
+from AttachAndRunProbers import DeferredAttachBPF,AttachFunc,DetachFunc
+
+# Per-call cost of the function probes on a loopback TCP stream, kprobe/kretprobe against
+# fentry/fexit trampolines. The probes only count their hits, so the time they add to the
+# unprobed stream divided by the probed calls is the cost of the attach mechanism itself.
+# Usage (as root): python BenchProbeOverhead.py [messages] [message bytes]
+
+Messages=int(sys.argv[1]) if len(sys.argv)>1 else 200000
+MessageBytes=int(sys.argv[2]) if len(sys.argv)>2 else 64
+Repeat=5
+# Called for every message on the send or the receive side of the stream
+Functions=["tcp_sendmsg_locked","tcp_push","__tcp_transmit_skb","__ip_queue_xmit","ip_finish_output2",
+           "__dev_queue_xmit","__netif_receive_skb","ip_rcv_finish","tcp_v4_rcv","tcp_rcv_established",
+           "tcp_recvmsg","skb_copy_datagram_iter"]
+
+ProbeHeader="""
+BPF_PERCPU_ARRAY(hits, u64, 2);
+static __always_inline int count(u32 slot)
+{
+    u64 *value = hits.lookup(&slot);
+    if(value){*value += 1;}
+    return 0;
+}
+// Slot 0 counts entries, slot 1 returns, kprobes of every function share one pair
+int ktgenericprobe(struct pt_regs *ctx){return count(0);}
+int ktgenericretprobe(struct pt_regs *ctx){return count(1);}
+"""
+KfuncBody="""
+KFUNC_PROBE({0}){{return count(0);}}
+KRETFUNC_PROBE({0}){{return count(1);}}
+"""
+
+def __Stream():
+    # Seconds to push Messages messages of MessageBytes through one loopback connection
+    server=socket.socket()
+    server.bind(("127.0.0.1",0))
+    server.listen(1)
+    client=socket.create_connection(server.getsockname())
+    client.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    peer,_=server.accept()
+    total=Messages*MessageBytes
+    def drain():
+        received=0
+        while received<total:
+            data=peer.recv(65536)
+            if not data:
+                break
+            received+=len(data)
+    reader=threading.Thread(target=drain)
+    message=b"x"*MessageBytes
+    begin=time.perf_counter()
+    reader.start()
+    for i in range(Messages):
+        client.sendall(message)
+    reader.join()
+    elapsed=time.perf_counter()-begin
+    client.close()
+    peer.close()
+    server.close()
+    return elapsed
+
+def __Measure(bpf):
+    # Median seconds of the stream, and probed calls per stream
+    cost=[]
+    calls=0
+    before=0 if bpf is None else bpf["hits"].sum(0).value
+    for i in range(Repeat):
+        cost.append(__Stream())
+    if bpf is not None:
+        calls=bpf["hits"].sum(0).value-before
+    cost.sort()
+    return cost[len(cost)//2],calls/Repeat
+
+def __Report(name,elapsed,base,calls,attached):
+    line="{:<7} {:.0f}ns/msg".format(name,elapsed/Messages*1e9)
+    if base is not None:
+        extra=(elapsed-base)/calls*1e9 if calls else float("nan")
+        line+=" attached={} calls/msg={:.1f} overhead={:.0f}ns/call".format(attached,calls/Messages,extra)
+    print(line)
+
+if __name__ == "__main__":
+    fentry=BPF.support_kfunc()
+    source=ProbeHeader
+    if fentry:
+        source+="".join(KfuncBody.format(name) for name in Functions)
+    bpf=DeferredAttachBPF(text=source)
+    base,_=__Measure(None)
+    __Report("none",base,None,0,0)
+    for mode in ("kprobe","fentry"):
+        if mode=="fentry" and not fentry:
+            print("fentry  not supported by this kernel")
+            continue
+        attached=[]
+        for name in Functions:
+            try:
+                used=AttachFunc(bpf,name,mode=="fentry")
+            except Exception as e:
+                print("[LOG]{} not attached: {}".format(name,e))
+                continue
+            attached.append((name,used))
+            if used!=mode:
+                print("[LOG]{} fell back to {}".format(name,used))
+        elapsed,calls=__Measure(bpf)
+        __Report(mode,elapsed,base,calls,len(attached))
+        for name,used in attached:
+            DetachFunc(bpf,name,used)
@@ -0,0 +1,119 @@
+import os
+import random
+import sqlite3 as sql
+import sys
+import tempfile
+import time
+from TracerSchema import InitFunctionSchema,InitPacketSchema
+from BatchWriter import BatchWriter
+from TracerQuery import ScanBuckets,FlowSpecCalls,FlowPackets
+from IpAddress import PackAddress
+
+# Query latency of the Tracer access paths as FunctionInfo.db/PacketInfo.db grow.
+# Usage: python BenchQueryLatency.py [rows ...]
+# With the bucketed schema the numbers should stay flat, "legacy" shows the old untyped tables.
+
+Sizes=[int(item) for item in sys.argv[1:]] or [10000,100000,1000000]
+Repeat=50
+FlowPorts=(45290,43483)
+# Packet tables keep addresses packed, the queries pack theirs the same way
+Loopback=PackAddress("127.0.0.1")
+# Queries whose result does not depend on random arguments, both paths must return as many rows
+Checked=("flow","packet")
+
+def __Populate(database,rows,start,legacy):
+    funcRows=[]
+    specRows=[]
+    packetRows=[]
+    for i in range(start,rows):
+        t=1750000000+i*0.0001
+        pid=random.randint(1,64)
+        funcRows.append((t,i&1,random.randint(1,150000),pid))
+        if i%50==0:
+            # Fixed number of rows for the queried flow, the rest is other traffic
+            ports=FlowPorts if i%500==0 and i<50000 else (random.randint(1024,65535),80)
+            specRows.append((t,0,200007,pid,4,ports[0],ports[1],"127.0.0.1","127.0.0.1",""))
+            packetRows.append((t,0,0,60,b"\x00"*60,Loopback,Loopback,ports[0],ports[1],6,0,64,b"",b""))
+    tables=(("functionCall",funcRows),("SpecfunctionCall",specRows),("ipv4packets",packetRows))
+    if legacy:
+        for table,tableRows in tables:
+            database.executemany("INSERT INTO {} VALUES({})".format(table,",".join("?"*len(tableRows[0]))),tableRows)
+        database.commit()
+        return
+    # Same path as the probers, rows go to their time bucket
+    batch=BatchWriter(database)
+    for table,tableRows in tables:
+        for row in tableRows:
+            batch.insert(table,row)
+    batch.flush()
+
+def __LegacyQueries(database):
+    cursor=database.cursor()
+    return {
+        "flow":lambda:cursor.execute("SELECT * FROM SpecfunctionCall WHERE ID in (200002,200003,200004,200005,200006,200007) "
+                                     "and srcport = ? and dstport = ? and srcip = ? and dstip = ?",
+                                     (FlowPorts[0],FlowPorts[1],"127.0.0.1","127.0.0.1")).fetchall(),
+        "return":lambda:cursor.execute("SELECT * FROM functionCall WHERE time > ? and isRet = 1 and ID = ? and PID = ?",
+                                       (1750000000,random.randint(1,150000),random.randint(1,64))).fetchall(),
+        "window":lambda:cursor.execute("SELECT * FROM functionCall WHERE time >= ? and time<= ? and PID = ?",
+                                       (1750000000+5,1750000000+5.01,random.randint(1,64))).fetchall(),
+        "packet":lambda:cursor.execute("SELECT * FROM ipv4packets WHERE srcport = ? and dstport = ? and srcip = ? and dstip = ?",
+                                       (FlowPorts[0],FlowPorts[1],Loopback,Loopback)).fetchall(),
+    }
+
+def __BucketQueries(database):
+    return {
+        "flow":lambda:FlowSpecCalls(database,(200002,200003,200004,200005,200006,200007),
+                                    FlowPorts[0],FlowPorts[1],"127.0.0.1","127.0.0.1"),
+        "return":lambda:list(ScanBuckets(database,"functionCall","*","time > ? and isRet = 1 and ID = ? and PID = ?",
+                                         (1750000000,random.randint(1,150000),random.randint(1,64)),since=1750000000)),
+        "window":lambda:list(ScanBuckets(database,"functionCall","*","time >= ? and time<= ? and PID = ?",
+                                         (1750000000+5,1750000000+5.01,random.randint(1,64)),
+                                         since=1750000000+5,until=1750000000+5.01)),
+        "packet":lambda:FlowPackets(database,"ipv4packets",FlowPorts[0],FlowPorts[1],"127.0.0.1","127.0.0.1"),
+    }
+
+def __Measure(queries):
+    result={}
+    for name,query in queries.items():
+        cost=[]
+        for i in range(Repeat):
+            begin=time.perf_counter()
+            query()
+            cost.append(time.perf_counter()-begin)
+        cost.sort()
+        result[name]=cost[len(cost)//2]*1000
+    return result
+
+def __CreateLegacy(database):
+    database.execute("CREATE TABLE functionCall(time, isRet, ID ,PID)")
+    database.execute("CREATE TABLE SpecfunctionCall(time, isRet, ID ,PID,family,srcport,dstport,srcip,dstip,pkt)")
+    database.execute("CREATE TABLE ipv4packets(time, netif, direction, length ,content, srcip, dstip, srcport, dstport, prot, ipid, ttl, frag, option)")
+
+def Bench(legacy):
+    # Row counts of the Checked queries at every size
+    counts=[]
+    tmpdir=tempfile.mkdtemp()
+    database=sql.connect(os.path.join(tmpdir,"bench.db"))
+    if legacy:
+        __CreateLegacy(database)
+    else:
+        InitFunctionSchema(database)
+        InitPacketSchema(database)
+    filled=0
+    for rows in Sizes:
+        __Populate(database,rows,filled,legacy)
+        filled=rows
+        queries=__LegacyQueries(database) if legacy else __BucketQueries(database)
+        result=__Measure(queries)
+        counts.append([len(queries[name]()) for name in Checked])
+        print("{:<8} rows={:<9} ".format("legacy" if legacy else "bucketed",rows)+
+              " ".join("{}={:.3f}ms".format(name,cost) for name,cost in result.items()))
+    database.close()
+    return counts
+
+if __name__ == "__main__":
+    random.seed(0)
+    bucketed=Bench(False)
+    legacy=Bench(True)
+    print("same rows:",bucketed==legacy,bucketed)
@@ -0,0 +1,80 @@
+from collections import defaultdict
+from TracerQuery import ThreadCalls,LastListenCall,ListenCalls
+
+# Rebuild call windows of FunctionInfo.db in one ordered pass per thread.
+# A window of (timeStart, ID, PID) holds every functionCall row of PID with
+# timeStart <= time <= timeEnd, timeEnd being the first return (isRet = 1) of ID after timeStart.
+# Rows and their order are the same as
+#   SELECT * FROM functionCall WHERE time >= timeStart and time <= timeEnd and PID = PID
+# The pass reads rows lazily and stops where the last window closes.
+
+def __BuildPidWindows(database,pid,starts):
+    # starts: sorted distinct (timeStart, ID) of one thread, returns {(timeStart, ID): rows}
+    windows={}
+    rows=ThreadCalls(database,pid,starts[0][0])
+    # Open windows: [timeStart, ID, rows, timeEnd]
+    active=[]
+    nextStart=0
+    for row in rows:
+        rowTime=row[0]
+        while nextStart<len(starts) and starts[nextStart][0]<=rowTime:
+            active.append([starts[nextStart][0],starts[nextStart][1],[],None])
+            nextStart+=1
+        if not active:
+            continue
+        remain=[]
+        for window in active:
+            if window[3] is not None and rowTime>window[3]:
+                windows[(window[0],window[1])]=window[2]
+                continue
+            window[2].append(row)
+            if window[3] is None and row[1]==1 and row[2]==window[1] and rowTime>window[0]:
+                # Rows sharing the return's time still belong to the window
+                window[3]=rowTime
+            remain.append(window)
+        active=remain
+        if not active and nextStart>=len(starts):
+            break
+    rows.close()
+    for window in active:
+        # Windows without a return are dropped
+        if window[3] is not None:
+            windows[(window[0],window[1])]=window[2]
+    return windows
+
+def CollectCallWindows(database,anchors):
+    # anchors: list of (timeStart, ID, PID), result is aligned with it, None where no return was seen
+    starts=defaultdict(set)
+    for timeStart,ID,PID in anchors:
+        starts[PID].add((timeStart,ID))
+    windows={}
+    for PID,pidStarts in starts.items():
+        for (timeStart,ID),rows in __BuildPidWindows(database,PID,sorted(pidStarts)).items():
+            windows[(timeStart,ID,PID)]=rows
+    return [windows.get(anchor) for anchor in anchors]
+
+def LatestListenCalls(database,anchors):
+    # anchors: list of (time, PID), for each one the last SpecfunctionCall 30000x entry
+    # of that thread strictly before time, as a SpecfunctionCall row or None
+    times=defaultdict(set)
+    for anchorTime,PID in anchors:
+        times[PID].add(anchorTime)
+    latest={}
+    for PID,pidTimes in times.items():
+        pidTimes=sorted(pidTimes)
+        # Start the pass at the entry preceding the earliest anchor instead of the capture start
+        first=LastListenCall(database,PID,pidTimes[0])
+        if first is None:
+            first=pidTimes[0]
+        rows=ListenCalls(database,PID,first,pidTimes[-1])
+        nextTime=0
+        last=None
+        for row in rows:
+            while nextTime<len(pidTimes) and pidTimes[nextTime]<=row[0]:
+                latest[(pidTimes[nextTime],PID)]=last
+                nextTime+=1
+            last=row
+        while nextTime<len(pidTimes):
+            latest[(pidTimes[nextTime],PID)]=last
+            nextTime+=1
+    return [latest.get(anchor) for anchor in anchors]
@@ -0,0 +1,55 @@
+import hashlib
+import json
+import os
+import platform
+
+# Stamps of the generated startup files. BCC compiles from source on every load and cannot
+# take a compiled object back, so what is kept across restarts is everything before clang:
+# the BTF dump, relatedFuncD5.json, FuncIDMap.json and kProberFunc.c. They only change
+# with the kernel (release and BTF contents), the generator sources and the probe options.
+
+CacheDir="./.cache"
+VmlinuxBTF="/sys/kernel/btf/vmlinux"
+HashChunk=1<<20
+
+def FileHash(path):
+    # sha256 of a file, "" if it cannot be read
+    digest=hashlib.sha256()
+    try:
+        with open(path,"rb") as fo:
+            for chunk in iter(lambda:fo.read(HashChunk),b""):
+                digest.update(chunk)
+    except OSError:
+        return ""
+    return digest.hexdigest()
+
+def KernelKey():
+    return {"release":platform.release(),"btf":FileHash(VmlinuxBTF)}
+
+def BuildKey(sources,**options):
+    # Key of files generated from sources on this kernel with these options
+    key=KernelKey()
+    key["sources"]={source:FileHash(source) for source in sources}
+    key["options"]=options
+    return key
+
+def __StampFile(name):
+    return os.path.join(CacheDir,name+".key")
+
+def IsFresh(name,key,outputs):
+    # True when every output exists and was made under the same key
+    if not all(os.path.exists(output) for output in outputs):
+        return False
+    try:
+        with open(__StampFile(name),"r") as fo:
+            return json.load(fo)==key
+    except (OSError,ValueError):
+        return False
+
+def MarkFresh(name,key):
+    with open(__StampFile(name),"w") as fo:
+        json.dump(key,fo)
+
+def Invalidate(name):
+    if os.path.exists(__StampFile(name)):
+        os.remove(__StampFile(name))
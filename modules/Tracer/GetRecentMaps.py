@@ -6,69 +6,24 @@ import time
 import sqlite3 as sql
 import json as js
 from tqdm import tqdm
-from PSUtil import U32ToIpv4
+from TracerQuery import ReadConnection,RecentFlowSpecCalls,FunctionDB
+from CallWindows import CollectCallWindows,LatestListenCalls
 import time
 import os
 
+RecvIDs=(200000,200001)
+SendIDs=(200002,200003,200004,200005,200006,200007)
+
 def GetRecentMaps(srcport,dstport,srcip,dstip,count,time:float):
-    # global database,attachtime
-    database=sql.connect("./.cache/FunctionInfo.db")
-    # global cursor
-    cursor=database.cursor()
-    commandStep1="SELECT * FROM SpecfunctionCall WHERE ID in (200000,200001) and time > {} and ((srcport = {} and dstport = {} and srcip = '{}' and dstip = '{}') or (srcport = {} and dstport = {} and srcip = '{}' and dstip = '{}'))".format(time,srcport,dstport,srcip,dstip,dstport,srcport,dstip,srcip)
-    cursor.execute(commandStep1)
-    result=cursor.fetchall()
-    result.reverse()
-    dataset=[]
-    Ncount=0
-    for item in result:
-        Ncount+=1
-        timeStart=item[0]
-        IDnow=item[2]
-        PIDnow=item[3]
-        commandStep2="SELECT * FROM SpecfunctionCall WHERE ID > 299999 and PID = {} and time < {}".format(PIDnow,timeStart)
-        cursor.execute(commandStep2)
-        result2=cursor.fetchall()
-        if len(result2)<=0:
-            continue
-        CorCall=result2[-1]
-        timeStartR=CorCall[0]
-        IDnow=CorCall[2]
-        PIDnow=CorCall[3]
-        commandStep3="SELECT * FROM functionCall WHERE time > {} and isRet = 1 and ID = {} and PID = {}".format(timeStartR,IDnow,PIDnow)
-        cursor.execute(commandStep3)
-        result3=cursor.fetchall()
-        if len(result3)<=0:
-            continue
-        timeEnd=result3[0][0]
-        commandStep4="SELECT * FROM functionCall WHERE time >= {} and time<= {} and PID = {}".format(timeStartR,timeEnd,PIDnow)
-        cursor.execute(commandStep4)
-        result4=cursor.fetchall()
-        dataset.append(result4)
-        if Ncount>=count:
-            break
-    commandStep1="SELECT * FROM SpecfunctionCall WHERE ID in (200002,200003,200004,200005,200006,200007) and time > {} and ((srcport = {} and dstport = {} and srcip = '{}' and dstip = '{}') or (srcport = {} and dstport = {} and srcip = '{}' and dstip = '{}'))".format(time, dstport, srcport, dstip, srcip, srcport, dstport, srcip, dstip)
-    cursor.execute(commandStep1)
-    result=cursor.fetchall()
-    result.reverse()
-    Ncount=0
-    dataset2=[]
-    for item in result:
-        Ncount+=1
-        timeStart=item[0]
-        IDnow=item[2]
-        PIDnow=item[3]
-        commandStep2="SELECT * FROM functionCall WHERE time > {} and isRet = 1 and ID = {} and PID = {}".format(timeStart,IDnow,PIDnow)
-        cursor.execute(commandStep2)
-        result2=cursor.fetchall()
-        # print(result2)
-        if len(result2)<=0:
-            continue
-        timeEnd=result2[0][0]
-        commandStep3="SELECT * FROM functionCall WHERE time >= {} and time<= {} and PID = {}".format(timeStart,timeEnd,PIDnow)
-        cursor.execute(commandStep3)
-        result3=cursor.fetchall()
-        dataset2.append(result3)
-        if Ncount>=count:
-            break
-    return js.dumps([dataset,dataset2])
\ No newline at end of file
+    # Windows of the newest count packets after time, newest first, for each side
+    with ReadConnection(FunctionDB) as database:
+        # Receive side: packet -> 30000x entry of the same thread before it -> window
+        result=RecentFlowSpecCalls(database,RecvIDs,srcport,dstport,srcip,dstip,count,since=time)
+        corCalls=LatestListenCalls(database,[(item[0],item[3]) for item in result])
+        anchors=[(CorCall[0],CorCall[2],CorCall[3]) for CorCall in corCalls if CorCall is not None]
+        dataset=[window for window in CollectCallWindows(database,anchors) if window is not None]
+        # Send side: window from the send call itself
+        result=RecentFlowSpecCalls(database,SendIDs,dstport,srcport,dstip,srcip,count,since=time)
+        anchors=[(item[0],item[2],item[3]) for item in result]
+        dataset2=[window for window in CollectCallWindows(database,anchors) if window is not None]
+    return js.dumps([dataset,dataset2])
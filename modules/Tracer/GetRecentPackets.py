@@ -6,7 +6,8 @@ import time
 import sqlite3 as sql
 import json as js
 from tqdm import tqdm
-from PSUtil import U32ToIpv4
+from PSUtil import EncodePacketRows
+from TracerQuery import ReadConnection,RecentFlowPackets,PacketDB
 import time
 import os
 
@@ -14,33 +15,22 @@ import os
 #     array=[]
 #     for item in input:
 
-def GetRecentPackets(srcport,dstport,srcip,dstip,ipver,count):
+def GetRecentPackets(srcport,dstport,srcip,dstip,ipver,count,encoding="hex"):
     # srcport=sys.argv[1]
     # dstport=sys.argv[2]
     # srcip=sys.argv[3]
     # dstip=sys.argv[4]
     # ipver=sys.argv[5]
 
-    # global database,attachtime
-    database=sql.connect("./.cache/PacketInfo.db")
-    # global cursor
-    cursor=database.cursor()
     Tabel="ipv4packets"
     if ipver == '4' or ipver == 4:
         Tabel="ipv4packets"
     elif ipver == '6' or ipver == 6:
         Tabel="ipv6packets"
     
-    # Step 1 :Extract all entries
-
-    commandStep1="SELECT * FROM {} WHERE srcport = {} and dstport = {} and srcip = '{}' and dstip = '{}'".format(Tabel,srcport,dstport,srcip,dstip)
-    # print(commandStep1)
-    # commandStep1Test="SELECT * FROM SpecfunctionCall WHERE PID = 610"
-    cursor.execute(commandStep1)
-    result1=cursor.fetchall()[-count:]
-    commandStep1="SELECT * FROM {} WHERE srcport = {} and dstport = {} and srcip = '{}' and dstip = '{}'".format(Tabel,dstport,srcport,dstip,srcip)
-    cursor.execute(commandStep1)
-    result2=cursor.fetchall()[-count:]
-    cursor.close()
+    # Step 1 :Newest count packets of both directions, returned oldest first
+    with ReadConnection(PacketDB) as database:
+        result=RecentFlowPackets(database,Tabel,srcport,dstport,srcip,dstip,count)
+    result.reverse()
     # sys.stdout.write(js.dumps(result))
-    return js.dumps(result1+result2)
\ No newline at end of file
+    return js.dumps(EncodePacketRows(result,encoding))
\ No newline at end of file
@@ -1,4 +1,6 @@
 import sqlite3 as sql
+from collections import Counter
+from TracerSchema import ListBuckets
 
 
 global database,attachtime
@@ -6,15 +8,18 @@ database=sql.connect("./.cache/FunctionInfo.db")
 global cursor
 cursor=database.cursor()
 
-cursor.execute("SELECT name FROM pragma_table_info('SpecfunctionCall')")
+buckets=ListBuckets(database)
+cursor.execute("SELECT name FROM pragma_table_info(?)",([name for bucket,table,name in buckets if table=="SpecfunctionCall"][0],))
 database.commit()
 print(cursor.fetchall())
-cursor.execute("SELECT ID, COUNT(*) AS sales_count FROM functionCall GROUP BY ID ORDER BY sales_count DESC")
-# cursor.execute("FROM functionCall")
-# cursor.execute("GROUP BY ID")
-# cursor.execute("ORDER BY sales_count DESC;")
+# Calls per ID over every functionCall bucket
+counts=Counter()
+for bucket,table,name in buckets:
+    if table=="functionCall":
+        cursor.execute("SELECT ID, COUNT(*) FROM {} GROUP BY ID".format(name))
+        counts.update(dict(cursor.fetchall()))
 database.commit()
-print(cursor.fetchall())
+print(counts.most_common())
 # [(36068, 1204211), (36072, 1204190), (56893, 1193557), (111443, 1184999), (119724, 1184997), (138163, 1175991), (121812, 934572), (68526, 498577), (84954, 496853), (135594, 482325), (135604, 448916), (135605, 447970), (129406, 447136), (135567, 446493), (116419, 446420), (112208, 443916), (135599, 440769), (112190, 439392), (112077, 438864), (112309, 438837), (84952, 438333), (138142, 437777), (135643, 436442), (119725, 425724), (111444, 425724), (111437, 421610), (138164, 419696), (36070, 67629), (36074, 42424)]
 DisabledList=["____sys_recvmsg","___sys_recvmsg","sock_recvmsg","security_socket_recvmsg",
               "apparmor_socket_recvmsg","unix_stream_recvmsg","consume_skb",
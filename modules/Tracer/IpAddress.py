@@ -0,0 +1,58 @@
+import socket
+from functools import lru_cache
+
+# Addresses are handled packed: 4 or 16 bytes in network order, or as integers the
+# way the kprobe events carry them. Comparisons never build text. Text is only made
+# for output, in the canonical inet_ntop form (IPv6 compressed, "fe80::250:56ff:fec0:2222"),
+# and cached, since a capture sees few distinct addresses.
+
+# Distinct addresses kept formatted, per family
+FormatCacheSize=4096
+
+def PackAddress(ipstr):
+    # Text address -> 4 or 16 packed bytes in network order, raises OSError if it is neither
+    try:
+        return socket.inet_pton(socket.AF_INET,ipstr)
+    except OSError:
+        return socket.inet_pton(socket.AF_INET6,ipstr)
+
+@lru_cache(maxsize=FormatCacheSize)
+def FormatAddress(packed):
+    # Packed address -> text, anything else is returned as it is
+    if isinstance(packed,bytes):
+        if len(packed)==4:
+            return socket.inet_ntop(socket.AF_INET,packed)
+        if len(packed)==16:
+            return socket.inet_ntop(socket.AF_INET6,packed)
+    return packed
+
+def CanonicalAddress(ipstr):
+    # Any accepted spelling of an address -> the text FormatAddress gives, unchanged if it is not one
+    try:
+        return FormatAddress(PackAddress(ipstr))
+    except (OSError,TypeError):
+        return ipstr
+
+# Event side: the kprobe events keep IPv4 as a u32 with the first address byte lowest,
+# and IPv6 as 16 bytes, read here as one big endian integer
+
+def Ipv4Key(ipstr):
+    return int.from_bytes(socket.inet_pton(socket.AF_INET,ipstr),"little")
+
+def Ipv6Key(ipstr):
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6,ipstr),"big")
+
+def AddressKey(ipstr):
+    # (family, integer) of a text address, compared against events of that family
+    try:
+        return 4,Ipv4Key(ipstr)
+    except OSError:
+        return 6,Ipv6Key(ipstr)
+
+@lru_cache(maxsize=FormatCacheSize)
+def FormatIpv4(value):
+    return socket.inet_ntop(socket.AF_INET,value.to_bytes(4,"little"))
+
+@lru_cache(maxsize=FormatCacheSize)
+def FormatIpv6(value):
+    return socket.inet_ntop(socket.AF_INET6,value.to_bytes(16,"big"))
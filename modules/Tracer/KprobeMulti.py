@@ -0,0 +1,76 @@
+import ctypes
+import os
+import platform
+
+# kprobe.multi links (Linux >= 5.18): one BPF_LINK_CREATE attaches one program to a whole
+# list of functions, with a per-function cookie the program reads via bpf_get_attach_cookie.
+# BCC has no Python API for it, so the link is created through the bpf() syscall here.
+# The program has to be loaded with expected_attach_type BPF_TRACE_KPROBE_MULTI.
+
+BPF_LINK_CREATE=28
+BPF_TRACE_KPROBE_MULTI=42
+BPF_F_KPROBE_MULTI_RETURN=1
+
+# bpf() syscall number per architecture
+SyscallNumbers={"x86_64":321,"aarch64":280,"riscv64":280,"s390x":351,"ppc64le":361,"loongarch64":280}
+
+# Only functions with an ftrace entry and not on the kprobe blacklist can go into a link,
+# a single other name fails the whole link
+FilterFunctionFiles=["/sys/kernel/tracing/available_filter_functions",
+                     "/sys/kernel/debug/tracing/available_filter_functions"]
+KprobeBlacklistFile="/sys/kernel/debug/kprobes/blacklist"
+
+class LinkCreateAttr(ctypes.Structure):
+    # link_create member of union bpf_attr, kprobe_multi variant
+    _fields_=[("prog_fd",ctypes.c_uint32),
+              ("target_fd",ctypes.c_uint32),
+              ("attach_type",ctypes.c_uint32),
+              ("flags",ctypes.c_uint32),
+              ("kprobe_multi_flags",ctypes.c_uint32),
+              ("cnt",ctypes.c_uint32),
+              ("syms",ctypes.c_uint64),
+              ("addrs",ctypes.c_uint64),
+              ("cookies",ctypes.c_uint64)]
+
+__libc=ctypes.CDLL(None,use_errno=True)
+
+def __ReadNames(path,column):
+    # Given column of every line, None if the file cannot be read
+    try:
+        with open(path) as fo:
+            return {line.split()[column] for line in fo if len(line.split())>column}
+    except OSError:
+        return None
+
+def TraceableFunctions():
+    # Names of vmlinux functions kprobe.multi can attach to, lines of modules end in [module]
+    traceable=set()
+    for path in FilterFunctionFiles:
+        try:
+            with open(path) as fo:
+                traceable={line.strip() for line in fo if line.strip() and "[" not in line}
+            break
+        except OSError:
+            continue
+    # blacklist lines are "0xstart-0xend\tname"
+    return traceable-(__ReadNames(KprobeBlacklistFile,1) or set())
+
+def AttachKprobeMulti(progfd,names,cookies,retprobe=False):
+    # One link for every name, returns the link fd, closing it detaches all of them
+    number=SyscallNumbers.get(platform.machine())
+    if number is None:
+        raise OSError("bpf() syscall number unknown on {}".format(platform.machine()))
+    syms=(ctypes.c_char_p*len(names))(*[name.encode() for name in names])
+    values=(ctypes.c_uint64*len(cookies))(*cookies)
+    attr=LinkCreateAttr()
+    attr.prog_fd=progfd
+    attr.attach_type=BPF_TRACE_KPROBE_MULTI
+    attr.kprobe_multi_flags=BPF_F_KPROBE_MULTI_RETURN if retprobe else 0
+    attr.cnt=len(names)
+    attr.syms=ctypes.addressof(syms)
+    attr.cookies=ctypes.addressof(values)
+    fd=__libc.syscall(number,BPF_LINK_CREATE,ctypes.byref(attr),ctypes.sizeof(attr))
+    if fd<0:
+        errno=ctypes.get_errno()
+        raise OSError(errno,"kprobe.multi link: {}".format(os.strerror(errno)))
+    return fd
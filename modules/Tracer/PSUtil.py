@@ -1,29 +1,5 @@
 
-def U32ToIpv4(input):
-    firstByte=(input>>24)&0x000000FF
-    secondByte=(input>>16)&0x000000FF
-    thirdByte=(input>>8)&0x000000FF
-    lastByte=(input)&0x000000FF
-    return str(lastByte)+"."+str(thirdByte)+"."+str(secondByte)+"."+str(firstByte)
-
-def ArrayToIpv4(input):
-    firstByte=input[3]
-    secondByte=input[2]
-    thirdByte=input[1]
-    lastByte=input[0]
-    return str(lastByte)+"."+str(thirdByte)+"."+str(secondByte)+"."+str(firstByte)
-
-
-def ArrayToIpv6(input):
-    strM=""
-    for i in range(16):
-        t=hex(input[i])[2:]
-        if len(t)==1:
-            t="0"+t
-        strM+=t
-        if i%2==1 and i!=15:
-            strM+=":"
-    return strM
+import base64
 
 def getInfoTypeName(id):
     if id==0:
@@ -36,3 +12,23 @@ def getInfoTypeName(id):
         return "netif_rx_exit"
     else:
         return "Illegal Code, Check Dev"
+
+
+# Encodings accepted for BLOB columns of PacketInfo.db
+BlobEncodings=("hex","base64","raw")
+
+def EncodeBlob(value,encoding="hex"):
+    # raw gives the byte values as a list, which JSON can carry
+    if not isinstance(value,bytes):
+        return value
+    if encoding=="hex":
+        return value.hex()
+    elif encoding=="base64":
+        return base64.b64encode(value).decode("ascii")
+    elif encoding=="raw":
+        return list(value)
+    raise ValueError("Unknown encoding {}".format(encoding))
+
+def EncodePacketRows(rows,encoding="hex"):
+    # content, and frag/option of ipv4packets, are BLOBs; only returned rows get encoded
+    return [[EncodeBlob(col,encoding) for col in row] for row in rows]
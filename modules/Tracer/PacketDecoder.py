@@ -0,0 +1,135 @@
+import ctypes
+import numpy as np
+
+# Batch decoder of the tcx ring buffer records of tcxProber.c.
+# The poll callback only copies each record, then all records drained by one poll
+# are decoded together: the header bytes of every packet are laid out as one
+# (N, HeaderBytes) matrix and ethertype, IP version, protocol, TTL, IP ID and ports
+# come out as NumPy columns. Addresses stay packed, they are formatted at query time.
+# Row tuples are only built when the batch is iterated, which WriterThread does on its own thread.
+
+# Mirror of struct packet_metadata in tcxProber.c, caplen bytes of the packet follow it
+MetadataDtype=np.dtype([("direction","<u8"),("timestamp","<u8"),("netifidx","<u8"),
+                        ("payloadlen","<u8"),("caplen","<u8")])
+MetadataSize=MetadataDtype.itemsize
+CaplenOffset=MetadataDtype.fields["caplen"][1]
+# Ethernet 14 + IPv4 header up to 60 + 4 port bytes, also covers the 58 bytes IPv6 needs
+HeaderBytes=78
+RecordDtype=np.dtype([("meta",MetadataDtype),("header","u1",HeaderBytes)])
+
+ETH_P_IP=0x0800
+ETH_P_IPV6=0x86dd
+# Row kinds of DecodeRecords
+KindOther=0
+KindIpv4Ports=1
+KindIpv4Icmp=2
+KindIpv6Ports=3
+KindIpv6Icmp=4
+
+def CopyRecord(data,size):
+    # Metadata and the captured bytes of the record at data, records have the size of their snap class
+    caplen=min(ctypes.c_uint64.from_address(data+CaplenOffset).value,size-MetadataSize)
+    return ctypes.string_at(data,MetadataSize+caplen)
+
+def RecordTimestamp(record):
+    return int(np.frombuffer(record,dtype=MetadataDtype,count=1)["timestamp"][0])
+
+def __HeaderMatrix(records):
+    # Fixed width copy of the start of every record, short records are zero padded
+    width=RecordDtype.itemsize
+    flat=b"".join([record[:width].ljust(width,b"\0") for record in records])
+    return np.frombuffer(flat,dtype=RecordDtype)
+
+def DecodeColumns(records):
+    # One pass over N records, returns a dict of NumPy columns of length N
+    matrix=__HeaderMatrix(records)
+    meta=matrix["meta"]
+    header=matrix["header"]
+    sizes=np.fromiter(map(len,records),dtype=np.int64,count=len(records))
+    caplen=np.minimum(meta["caplen"].astype(np.int64),sizes-MetadataSize)
+    ethertype=(header[:,12].astype(np.uint16)<<8)|header[:,13]
+    version=header[:,14]&0xf0
+    isip=(caplen>=14)&((ethertype==ETH_P_IP)|(ethertype==ETH_P_IPV6))
+    ipv4=isip&(version==64)&(caplen>=34)
+    ipv6=isip&(version==96)&(caplen>=58)
+    # IPv4: protocol at 23, ports right after the variable length header
+    rows=np.arange(len(records))
+    nextprotstart=(header[:,14]&0x0f).astype(np.int64)*4+14
+    prot4=header[:,23]
+    ipv4ports=ipv4&((prot4==6)|(prot4==17))
+    ipv4icmp=ipv4&(prot4==1)
+    portsin=caplen>=nextprotstart+4
+    srcport4=(header[rows,nextprotstart].astype(np.int64)<<8)|header[rows,nextprotstart+1]
+    dstport4=(header[rows,nextprotstart+2].astype(np.int64)<<8)|header[rows,nextprotstart+3]
+    srcport4=np.where(portsin,srcport4,0)
+    dstport4=np.where(portsin,dstport4,0)
+    # IPv6: next header at 20, ports at 54
+    prot6=header[:,20]
+    ipv6ports=ipv6&((prot6==6)|(prot6==17))
+    ipv6icmp=ipv6&(prot6==58)
+    srcport6=(header[:,54].astype(np.int64)<<8)|header[:,55]
+    dstport6=(header[:,56].astype(np.int64)<<8)|header[:,57]
+    kind=np.full(len(records),KindOther,dtype=np.int64)
+    kind[ipv4ports]=KindIpv4Ports
+    kind[ipv4icmp]=KindIpv4Icmp
+    kind[ipv6ports]=KindIpv6Ports
+    kind[ipv6icmp]=KindIpv6Icmp
+    return {
+        "kind":kind,
+        "direction":meta["direction"],
+        "timestamp":meta["timestamp"],
+        "payloadlen":meta["payloadlen"],
+        "caplen":caplen,
+        "ethertype":ethertype,
+        "version":version>>4,
+        "prot":np.where(ipv4,prot4,prot6),
+        "ttl":header[:,22],
+        "ipid":(header[:,18].astype(np.int64)<<8)|header[:,19],
+        "nextprotstart":nextprotstart,
+        # 0 for ICMP and anything else without ports
+        "srcport":np.where(ipv4ports,srcport4,np.where(ipv6ports,srcport6,0)),
+        "dstport":np.where(ipv4ports,dstport4,np.where(ipv6ports,dstport6,0)),
+    }
+
+class PacketBatch:
+    # (table, row) pairs of one poll in the column order of PacketInfo.db,
+    # times are basetime + (timestamp - start) ns
+    def __init__(self,records,basetime,start):
+        self.records=records
+        self.columns=DecodeColumns(records) if records else None
+        self.basetime=basetime
+        self.start=start
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        if not self.records:
+            return
+        columns=self.columns
+        times=(self.basetime+(columns["timestamp"].astype(np.int64)-self.start)/1000000000).tolist()
+        kind=columns["kind"].tolist()
+        direction=columns["direction"].tolist()
+        payloadlen=columns["payloadlen"].tolist()
+        caplen=columns["caplen"].tolist()
+        prot=columns["prot"].tolist()
+        ttl=columns["ttl"].tolist()
+        ipid=columns["ipid"].tolist()
+        nextprotstart=columns["nextprotstart"].tolist()
+        srcport=columns["srcport"].tolist()
+        dstport=columns["dstport"].tolist()
+        for i,record in enumerate(self.records):
+            payload=record[MetadataSize:MetadataSize+caplen[i]]
+            rowkind=kind[i]
+            if rowkind==KindIpv4Ports or rowkind==KindIpv4Icmp:
+                yield ("ipv4packets",(times[i],0,direction[i],payloadlen[i],payload,payload[26:30],payload[30:34],
+                       srcport[i],dstport[i],prot[i],ipid[i],ttl[i],payload[20:22],payload[34:nextprotstart[i]]))
+            elif rowkind==KindIpv6Ports or rowkind==KindIpv6Icmp:
+                yield ("ipv6packets",(times[i],0,direction[i],payloadlen[i],payload,payload[22:38],payload[38:54],
+                       prot[i],srcport[i],dstport[i]))
+            else:
+                yield ("otherpackets",(times[i],0,direction[i],payloadlen[i],payload))
+
+def DecodeRecords(records,basetime,start):
+    # Header columns are decoded now, rows when the result is iterated
+    return PacketBatch(records,basetime,start)
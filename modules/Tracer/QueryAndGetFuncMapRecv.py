@@ -6,7 +6,8 @@ import time
 import sqlite3 as sql
 import json as js
 from tqdm import tqdm
-from PSUtil import U32ToIpv4
+from CallWindows import CollectCallWindows,LatestListenCalls
+from TracerQuery import ReadConnection,FlowSpecCalls,FunctionDB
 import time
 import os
 
@@ -20,52 +21,20 @@ import os
 # dstport=sys.argv[2]
 # srcip=sys.argv[3]
 # dstip=sys.argv[4]
+RecvIDs=(200000,200001)
+
 def QueryAndGetFuncMapRecv(srcport,dstport,srcip,dstip):
-    # global database,attachtime
-    database=sql.connect("./.cache/FunctionInfo.db")
-    # global cursor
-    cursor=database.cursor()
 # Step 1: Extract all entries with ID 200001/200002/300000/300001/300002/300003
 # Step 2: Filter all entries with 200001/200002
 # Step 3: Get all 30000x entries with same PID and just before 200001 -> -1 of list
 # Step 4: Query that entry and match that packet
-
-    commandStep1="SELECT * FROM SpecfunctionCall WHERE ID in (200000,200001) and srcport = {} and dstport = {} and srcip = '{}' and dstip = '{}'".format(srcport,dstport,srcip,dstip)
-    # commandStep1Test="SELECT * FROM SpecfunctionCall WHERE PID = 610"
-    cursor.execute(commandStep1)
-    result=cursor.fetchall()
-    # print(result)
-    #Step 2 :Extract all entries
-    dataset=[]
-
-    for item in result:
-        timeStart=item[0]
-        IDnow=item[2]
-        PIDnow=item[3]
-        commandStep2="SELECT * FROM SpecfunctionCall WHERE ID > 299999 and PID = {} and time < {}".format(PIDnow,timeStart)
-        cursor.execute(commandStep2)
-        result2=cursor.fetchall()
-        # print(result2)
-        if len(result2)<=0:
-            continue
-        # print(result2)
-        CorCall=result2[-1]
-        timeStartR=CorCall[0]
-        IDnow=CorCall[2]
-        PIDnow=CorCall[3]
-        commandStep3="SELECT * FROM functionCall WHERE time > {} and isRet = 1 and ID = {} and PID = {}".format(timeStartR,IDnow,PIDnow)
-        cursor.execute(commandStep3)
-        result3=cursor.fetchall()
-        # print(result3)
-        # print(result2)
-        if len(result3)<=0:
-            continue
-        timeEnd=result3[0][0]
-        commandStep4="SELECT * FROM functionCall WHERE time >= {} and time<= {} and PID = {}".format(timeStartR,timeEnd,PIDnow)
-        cursor.execute(commandStep4)
-        result4=cursor.fetchall()
-        dataset.append(result4)
-        # print(result3)
+    with ReadConnection(FunctionDB) as database:
+        result=FlowSpecCalls(database,RecvIDs,srcport,dstport,srcip,dstip)
+        # print(result)
+        #Step 2 :Get the 30000x entry of the same thread just before each packet
+        corCalls=LatestListenCalls(database,[(item[0],item[3]) for item in result])
+        #Step 3 :Rebuild windows from that entry to its return, one pass per thread
+        anchors=[(CorCall[0],CorCall[2],CorCall[3]) for CorCall in corCalls if CorCall is not None]
+        dataset=[window for window in CollectCallWindows(database,anchors) if window is not None]
     # sys.stdout.write(js.dumps(dataset))
-    cursor.close()
-    return js.dumps(dataset)
\ No newline at end of file
+    return js.dumps(dataset)
@@ -6,7 +6,8 @@ import time
 import sqlite3 as sql
 import json as js
 from tqdm import tqdm
-from PSUtil import U32ToIpv4
+from CallWindows import CollectCallWindows
+from TracerQuery import ReadConnection,FlowSpecCalls,FunctionDB
 import time
 import os
 
@@ -17,41 +18,15 @@ import os
     # dstport=sys.argv[2]
     # srcip=sys.argv[3]
     # dstip=sys.argv[4]
-def QueryAndGetFuncMapSend(srcport,dstport,srcip,dstip):
-    # global database,attachtime
-    database=sql.connect("./.cache/FunctionInfo.db")
-    # global cursor
-    cursor=database.cursor()
-
-    # Step 1 :Extract all entries
-
-    commandStep1="SELECT * FROM SpecfunctionCall WHERE ID in (200002,200003,200004,200005,200006,200007) and srcport = {} and dstport = {} and srcip = '{}' and dstip = '{}'".format(srcport,dstport,srcip,dstip)
-    # commandStep1="SELECT * FROM SpecfunctionCall WHERE srcport = {}".format(srcport)
+SendIDs=(200002,200003,200004,200005,200006,200007)
 
-    # commandStep1Test="SELECT * FROM SpecfunctionCall WHERE PID = 610" ID in (200002,200003,200004,200005,200006,200007) and 
-    # print(commandStep1)
-    cursor.execute(commandStep1)
-    result=cursor.fetchall()
-    # print(result)
-    #Step 2 :Extract all entries
-    dataset=[]
-
-    for item in result:
-        timeStart=item[0]
-        IDnow=item[2]
-        PIDnow=item[3]
-        commandStep2="SELECT * FROM functionCall WHERE time > {} and isRet = 1 and ID = {} and PID = {}".format(timeStart,IDnow,PIDnow)
-        cursor.execute(commandStep2)
-        result2=cursor.fetchall()
-        # print(result2)
-        if len(result2)<=0:
-            continue
-        timeEnd=result2[0][0]
-        commandStep3="SELECT * FROM functionCall WHERE time >= {} and time<= {} and PID = {}".format(timeStart,timeEnd,PIDnow)
-        cursor.execute(commandStep3)
-        result3=cursor.fetchall()
-        dataset.append(result3)
-        # print(result3)
+def QueryAndGetFuncMapSend(srcport,dstport,srcip,dstip):
+    with ReadConnection(FunctionDB) as database:
+        # Step 1 :Extract all entries
+        result=FlowSpecCalls(database,SendIDs,srcport,dstport,srcip,dstip)
+        # print(result)
+        #Step 2 :Rebuild windows from each entry to its return, one pass per thread
+        anchors=[(item[0],item[2],item[3]) for item in result]
+        dataset=[window for window in CollectCallWindows(database,anchors) if window is not None]
     # sys.stdout.write(js.dumps(dataset))
-    cursor.close()
-    return js.dumps(dataset)
\ No newline at end of file
+    return js.dumps(dataset)
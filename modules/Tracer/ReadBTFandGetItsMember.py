@@ -1,75 +1,129 @@
 import json as js
-import tqdm as tq
+import resource
+import subprocess
+from array import array
+from collections import deque
+from CompileCache import FileHash,VmlinuxBTF
+from BTFReader import ReadRawBTF,FromDump,KindNumbers,LinkageNames
 
-def rebuild_json(inputlist):
-    dictnow={}
-    for item in inputlist:
-        dictnow[item["id"]]=item
-    return dictnow
+# Types are read from the raw BTF by BTFReader.
+# Types related to sk_buff are the ones reaching it through STRUCT members or ARRAY/VOLATILE/CONST/PTR,
+# every FUNC with a parameter of such a type is traced. They used to be found by sweeping all types
+# in dump order up to MaxPasses times, a type joining in the sweep that first sees a related type it
+# references, so one found earlier in the same sweep counts. A reverse reference index and a 0-1 BFS
+# give every type the sweep it joins in, which is the same set without rescanning the types.
+MaxPasses=5
+ReferenceKinds={KindNumbers[kind] for kind in ("ARRAY","VOLATILE","CONST","PTR")}
+StructKind=KindNumbers["STRUCT"]
+FuncKind=KindNumbers["FUNC"]
+ProtoKind=KindNumbers["FUNC_PROTO"]
 
-def ReadBTFandGetItsMember():
-# This file is to get all items that 
-    fo=open("./.cache/btf.json","r")
-    # stro=fo.read()
+BTFDumpFile="./.cache/btf.json"
+RelatedFuncFile="./.cache/relatedFuncD5.json"
+# The FUNC list of the last analysed vmlinux BTF, an unchanged kernel is neither dumped nor analysed again
+AnalysisCacheFile="./.cache/relatedFuncCache.json"
+# Sources of the analysis, their hashes are part of its key
+AnalysisSources=["ReadBTFandGetItsMember.py","BTFReader.py"]
+
+def __Targets(btf,typeid):
+    # Types a type reaches sk_buff through
+    kind=btf.kind[typeid]
+    if kind==StructKind:
+        return set(btf.members(typeid))
+    if kind in ReferenceKinds:
+        return (btf.typeid[typeid],)
+    return ()
+
+def __ReverseReferences(btf):
+    # Ids of the types referencing each type id, as referrers[start[id]:start[id+1]]
+    count=array("I",bytes(4*(len(btf)+1)))
+    for typeid in range(1,len(btf)):
+        for target in __Targets(btf,typeid):
+            count[target]+=1
+    start=array("I",[0])
+    for typeid in range(len(btf)):
+        start.append(start[-1]+count[typeid])
+    fill=array("I",start)
+    referrers=array("I",bytes(4*start[-1]))
+    for typeid in range(1,len(btf)):
+        for target in __Targets(btf,typeid):
+            referrers[fill[target]]=typeid
+            fill[target]+=1
+    return start,referrers
 
-    btfFile=js.load(fo)
-    L1list=btfFile["types"]
-    L1Dict=rebuild_json(L1list)
-    for item in L1list:
-        print(item["name"])
-        if item["name"]=="sk_buff":
-            skbid=item["id"]
-            print("get")
-            break
-        # break
-    Updated=True
-    Depth=1
-    relatedTypes=[skbid]
-    while Updated:
-        Updated=False
-        for item in L1list:
-            if item["id"] in relatedTypes:
+def __RelatedTypes(btf,skbid):
+    # Type ids follow dump order
+    start,referrers=__ReverseReferences(btf)
+    # sweep a type joins in, sk_buff is known before the first one
+    sweep={skbid:0}
+    queue=deque([skbid])
+    while queue:
+        current=queue.popleft()
+        for referrer in referrers[start[current]:start[current+1]]:
+            # Same sweep when the referrer comes after current in it
+            same=sweep[current]>0 and referrer>current
+            joined=sweep[current] if same else sweep[current]+1
+            if joined>MaxPasses or joined>=sweep.get(referrer,MaxPasses+1):
                 continue
-            # if item["kind"] == "STRUCT" or item["kind"] == "UNION":
-            if item["kind"] == "STRUCT":
-                for subitem in item["members"]:
-                    if subitem["type_id"] in relatedTypes:
-                        relatedTypes.append(item["id"])
-                        Updated=True
-                        break
-            elif item["kind"] == "ARRAY" or item["kind"]=="VOLATILE" \
-                or item["kind"]=="CONST" or item["kind"] == "PTR":
-                if item["type_id"] in relatedTypes:
-                    relatedTypes.append(item["id"])
-                    Updated=True
-                # continue
-        Depth+=1
-        if Depth>5:
-            break
-        print(len(relatedTypes))
-    # print(relatedTypes)
-        
-    # exit()
-    relatedFunc=[]
+            sweep[referrer]=joined
+            if same:
+                queue.appendleft(referrer)
+            else:
+                queue.append(referrer)
+    return set(sweep)
 
-    # First level is load a1 dict whose key is "types"
-    for item in tq.tqdm(L1list):
-        # iterate all items
-        if item["kind"]!="FUNC":
+def __RelatedFuncs(btf,related):
+    # FUNC entries in the form of the bpftool dump
+    relatedFunc=[]
+    for typeid in range(1,len(btf)):
+        if btf.kind[typeid]!=FuncKind:
             continue
-            # Just check FUNC
-        find_skb=False
-        p=L1Dict[item["type_id"]]
-        if p["kind"]=="FUNC_PROTO":
-            t=p["params"]
-            for para in t:
-                if para["type_id"] in relatedTypes:
-                    relatedFunc.append(item)
-                    find_skb==True
-                    break
+        proto=btf.typeid[typeid]
+        if btf.kind[proto]==ProtoKind and any(para in related for para in btf.members(proto)):
+            relatedFunc.append({"id":typeid,"kind":"FUNC","name":btf.name(typeid),"type_id":proto,
+                                "linkage":LinkageNames[btf.vlen[typeid]]})
+    return relatedFunc
 
-    ftw=open("./.cache/relatedFuncD5.json","w")
-    js.dump(relatedFunc,ftw)
-    ftw.close()
-        
+def __LoadTypes():
+    # Raw BTF, the bpftool JSON dump only if the kernel's BTF cannot be parsed here
+    try:
+        return ReadRawBTF(VmlinuxBTF)
+    except ValueError as e:
+        print("[LOG]{}, falling back to bpftool".format(e))
+    __DumpBTF()
+    with open(BTFDumpFile,"r") as fo:
+        return FromDump(js.load(fo)["types"])
 
+def __DumpBTF():
+    # bpftool -j btf dump file /sys/kernel/btf/vmlinux > ./.cache/btf.json
+    with open(BTFDumpFile,"w") as fo:
+        subprocess.run(["bpftool","-j","btf","dump","file",VmlinuxBTF],stdout=fo)
+
+def __LoadCache(key):
+    try:
+        with open(AnalysisCacheFile,"r") as fo:
+            cache=js.load(fo)
+    except (OSError,ValueError):
+        return None
+    return cache["funcs"] if cache.get("key")==key else None
+
+def __SaveCache(key,relatedFunc):
+    with open(AnalysisCacheFile,"w") as fo:
+        js.dump({"key":key,"funcs":relatedFunc},fo,separators=(",",":"))
+
+def ReadBTFandGetItsMember():
+    # BTF that cannot be hashed is analysed every time
+    key={"btf":FileHash(VmlinuxBTF),"passes":MaxPasses,"sources":{source:FileHash(source) for source in AnalysisSources}}
+    relatedFunc=__LoadCache(key) if key["btf"] else None
+    if relatedFunc is None:
+        btf=__LoadTypes()
+        related=__RelatedTypes(btf,btf.find("sk_buff","STRUCT"))
+        relatedFunc=__RelatedFuncs(btf,related)
+        print("[LOG]{} types related to sk_buff, {} functions, peak RSS {} MB".format(
+            len(related),len(relatedFunc),resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//1024))
+        if key["btf"]:
+            __SaveCache(key,relatedFunc)
+    else:
+        print("[LOG]BTF unchanged, reusing {}".format(AnalysisCacheFile))
+    with open(RelatedFuncFile,"w") as ftw:
+        js.dump(relatedFunc,ftw)
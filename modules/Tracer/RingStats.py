@@ -0,0 +1,31 @@
+import os
+
+# Accounting of the events ring of both probers (/Stats). Their programs count in the per CPU
+# array ring_stats the records they submitted and the ones lost because the ring was full when
+# reserving, the probers count what their ring callback consumed, and the writer the rows it
+# dropped with its queue full or lost to a failed write. Ring size is set at startup, it is
+# passed as EVENTS_RING_PAGES.
+
+# Slots of ring_stats, RING_SUBMITTED and RING_DROPPED of tcxProber.c and kProberFunc.c
+RingSubmitted=0
+RingDropped=1
+
+def RingPages(variable,default):
+    # Pages of a ring from the environment, the kernel takes powers of two only
+    pages=int(os.environ.get(variable,default))
+    if pages<=0 or pages&(pages-1):
+        raise ValueError("{} must be a power of two, not {}".format(variable,pages))
+    return pages
+
+def RingCflags(pages):
+    return ["-DEVENTS_RING_PAGES={}".format(pages)]
+
+def RingStats(bpf,pages,consumed,writer):
+    # Counters summed over the CPUs, records still in the ring are produced but not consumed yet
+    table=bpf["ring_stats"]
+    return {"ringPages":pages,
+            "produced":table.sum(RingSubmitted).value,
+            "consumed":consumed,
+            "droppedKernel":table.sum(RingDropped).value,
+            "droppedUser":writer.dropped,
+            "failedUser":writer.failed}
@@ -0,0 +1,179 @@
+import queue
+import threading
+import numpy as np
+from BatchWriter import WriterThread
+from TracerSchema import AllTables
+
+# In-memory backend: every table is a fixed-capacity ring of a NumPy structured array,
+# oldest rows are overwritten once it is full. Queries are mask scans over the ring,
+# rows come back as tuples of Python values, the same as sqlite3 returns them.
+
+# Rows kept per table, anything else gets DefaultRingRows
+RingRows={
+    "functionCall":2000000,
+    "SpecfunctionCall":200000,
+    "ipv4packets":100000,
+    "ipv6packets":50000,
+    "otherpackets":20000,
+}
+DefaultRingRows=100000
+# Rows converted to tuples at once when a scan is consumed lazily
+ScanChunkRows=4096
+
+# SQL column type -> NumPy field type, TEXT and BLOB keep the Python object
+FieldTypes={"REAL":"f8","INTEGER":"i8","TEXT":"O","BLOB":"O"}
+
+def RingDtype(columns):
+    fields=[]
+    for item in columns.split(","):
+        name,kind=item.split()[:2]
+        fields.append((name,FieldTypes[kind]))
+    return np.dtype(fields)
+
+class RingTable:
+    def __init__(self,columns,capacity):
+        self.dtype=RingDtype(columns)
+        self.data=np.zeros(capacity,dtype=self.dtype)
+        self.capacity=capacity
+        # Next slot to write, and number of valid rows
+        self.head=0
+        self.count=0
+
+    def append(self,rows):
+        block=np.array(rows,dtype=self.dtype)
+        if len(block)>=self.capacity:
+            block=block[-self.capacity:]
+        first=min(len(block),self.capacity-self.head)
+        self.data[self.head:self.head+first]=block[:first]
+        self.data[:len(block)-first]=block[first:]
+        self.head=(self.head+len(block))%self.capacity
+        self.count=min(self.count+len(block),self.capacity)
+
+    def order(self,slots):
+        # Insertion order of physical slots, 0 is the oldest row
+        if self.count<self.capacity:
+            return slots
+        return (slots-self.head)%self.capacity
+
+    def discard_before(self,cutoff):
+        valid=self.data[:self.count]
+        kept=valid[np.argsort(self.order(np.arange(self.count)),kind="stable")]
+        kept=kept[kept["time"]>=cutoff]
+        self.data=np.zeros(self.capacity,dtype=self.dtype)
+        self.data[:len(kept)]=kept
+        self.head=len(kept)%self.capacity
+        self.count=len(kept)
+
+class RingStore:
+    # One store per database path, shared by its RingWriter and the Flask query threads.
+    # A table's ring is allocated on its first row.
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.tables={}
+
+    def ring(self,table):
+        ring=self.tables.get(table)
+        if ring is None:
+            ring=RingTable(AllTables[table],RingRows.get(table,DefaultRingRows))
+            self.tables[table]=ring
+        return ring
+
+    def append(self,table,rows):
+        with self.lock:
+            self.ring(table).append(rows)
+
+    def clear(self,tables,cutoff):
+        with self.lock:
+            for table in tables:
+                if table in self.tables:
+                    self.tables[table].discard_before(cutoff)
+
+    def select(self,table,conds,columns=None,order=None,limit=None):
+        # conds: list of (column, op, value), op one of == > >= < <= in
+        # order: None for insertion order, "asc"/"desc" by time then insertion
+        # Matching rows are picked under the lock, converting them to tuples happens outside
+        with self.lock:
+            ring=self.ring(table)
+            valid=ring.data[:ring.count]
+            mask=np.ones(ring.count,dtype=bool)
+            for column,op,value in conds:
+                field=valid[column]
+                if op=="==":
+                    mask&=field==value
+                elif op==">":
+                    mask&=field>value
+                elif op==">=":
+                    mask&=field>=value
+                elif op=="<":
+                    mask&=field<value
+                elif op=="<=":
+                    mask&=field<=value
+                elif op=="in":
+                    mask&=np.isin(field,list(value))
+                else:
+                    raise ValueError("Unknown operator {}".format(op))
+            slots=np.flatnonzero(mask)
+            inserted=ring.order(slots)
+            if order is None:
+                slots=slots[np.argsort(inserted,kind="stable")]
+            else:
+                slots=slots[np.lexsort((inserted,valid["time"][slots]))]
+                if order=="desc":
+                    slots=slots[::-1]
+            if limit is not None and limit>=0:
+                slots=slots[:limit]
+            picked=valid[slots]
+        if columns is not None:
+            picked=picked[list(columns)]
+        return picked
+
+def IterRows(picked):
+    # Tuples of Python values, converted chunk by chunk so an early break stays cheap
+    for start in range(0,len(picked),ScanChunkRows):
+        yield from picked[start:start+ScanChunkRows].tolist()
+
+# path -> RingStore
+__stores={}
+
+def GetStore(path):
+    store=__stores.get(path)
+    if store is None:
+        store=__stores.setdefault(path,RingStore())
+    return store
+
+class RingWriter(WriterThread):
+    # Same producer side as WriterThread (insert/submit/request_clear, bounded queue,
+    # dropped and failed counters), but chunks are appended to the RingStore of dbpath instead of SQLite
+    def __init__(self,dbpath,**kwargs):
+        WriterThread.__init__(self,dbpath,**kwargs)
+        self.store=GetStore(dbpath)
+
+    def run(self):
+        while True:
+            try:
+                chunk=self.queue.get(timeout=self.maxdelay)
+            except queue.Empty:
+                chunk=None
+            # Rows of chunk not stored yet
+            left=0
+            try:
+                if self.clearrequest is not None:
+                    tables,self.cutoff=self.clearrequest
+                    self.clearrequest=None
+                    self.store.clear(tables,self.cutoff)
+                if chunk is None:
+                    continue
+                cutoff=self.cutoff
+                grouped={}
+                for table,row in chunk:
+                    if row[0]>=cutoff:
+                        grouped.setdefault(table,[]).append(row)
+                left=sum(len(rows) for rows in grouped.values())
+                for table,rows in grouped.items():
+                    self.store.append(table,rows)
+                    left-=len(rows)
+                    self.written+=len(rows)
+            except Exception as e:
+                # A row that does not fit its ring loses the rest of the chunk, the thread goes on
+                print("[LOG]Writer of {}: {}".format(self.dbpath,e))
+                self.failed+=left
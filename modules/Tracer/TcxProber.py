@@ -4,24 +4,120 @@ import ctypes
 # import timer
 import time
 import sqlite3 as sql
-from PSUtil import ArrayToIpv4,ArrayToIpv6
+from PacketDecoder import DecodeRecords,RecordTimestamp,CopyRecord
+from BatchWriter import WriterThread
+from TracerSchema import InitPacketSchema,StorageBackend
+from RingStore import RingWriter
+from IpAddress import PackAddress
+from RingStats import RingPages,RingCflags,RingStats
 import threading
 # global clear_flag_tcx
 # clear_flag_tcx=False
 # Reference program :
 # socketio from Brendan Gregg
 
+class FlowFilter(ctypes.Structure):
+    # Mirror of struct flow_filter in tcxProber.c
+    _fields_=[("enabled",ctypes.c_uint32),
+              ("family",ctypes.c_uint32),
+              ("prot",ctypes.c_uint32),
+              ("sport",ctypes.c_uint16),
+              ("dport",ctypes.c_uint16),
+              ("saddr",ctypes.c_uint32*4),
+              ("daddr",ctypes.c_uint32*4)]
+
+g_kfilter=FlowFilter()
+
+# Raw records copied by print_event, decoded as one batch after each poll
+pending=[]
+# Pages of the events ring (EVENTS_RING_PAGES of tcxProber.c), records taken out of it
+EventRingPages=RingPages("TRACER_TCX_RING_PAGES",128)
+consumed=0
+
+class CaptureConfig(ctypes.Structure):
+    # Mirror of struct capture_config in tcxProber.c
+    _fields_=[("snapclass",ctypes.c_uint32),
+              ("snaplen",ctypes.c_uint32)]
+
+# Record size classes in tcxProber.c : (snapclass, record payload size)
+SnapClasses={"header":(0,128),"512":(1,512),"full":(2,6144)}
+g_capconf=CaptureConfig(SnapClasses["full"][0],SnapClasses["full"][1])
+
+def __PackFilterAddr(ipstr,field):
+    # "" or "*" -> wildcard, return family of the address
+    if ipstr=="" or ipstr=="*":
+        return 0
+    packed=PackAddress(ipstr)
+    ctypes.memmove(field,packed,len(packed))
+    return 4 if len(packed)==4 else 6
+
+def SetKernelFilter(srcip,dstip,srcport,dstport,prot=0):
+    # Port <= 0 is wildcard, both directions of the flow are kept
+    newfilter=FlowFilter()
+    srcfamily=__PackFilterAddr(srcip,newfilter.saddr)
+    dstfamily=__PackFilterAddr(dstip,newfilter.daddr)
+    if srcfamily and dstfamily and srcfamily!=dstfamily:
+        raise ValueError("srcip and dstip are not in the same family")
+    newfilter.family=srcfamily or dstfamily
+    newfilter.prot=max(int(prot),0)
+    newfilter.sport=max(int(srcport),0)
+    newfilter.dport=max(int(dstport),0)
+    newfilter.enabled=1
+    global g_kfilter
+    g_kfilter=newfilter
+    __ApplyKernelFilter()
+
+def SetSnapLen(snaplen):
+    # "header"/"512"/"full", or a byte count which picks the smallest class able to hold it
+    global g_capconf
+    snaplen=str(snaplen).lower()
+    if snaplen in SnapClasses:
+        snapclass,length=SnapClasses[snaplen]
+    else:
+        length=int(snaplen)
+        if length<=0:
+            raise ValueError("snaplen must be positive")
+        for snapclass,classlen in sorted(SnapClasses.values()):
+            if length<=classlen:
+                break
+        length=min(length,classlen)
+    g_capconf=CaptureConfig(snapclass,length)
+    __ApplyCaptureConfig()
+    return length
+
+def __ApplyCaptureConfig():
+    if "bpfTcxTracer" not in globals():
+        return
+    table=bpfTcxTracer["capture_config"]
+    table[table.Key(0)]=g_capconf
+
+def UnsetKernelFilter():
+    global g_kfilter
+    g_kfilter=FlowFilter()
+    __ApplyKernelFilter()
+
+def __ApplyKernelFilter():
+    # Filter may be set before prober is built, it's applied again after build
+    if "bpfTcxTracer" not in globals():
+        return
+    table=bpfTcxTracer["flow_filter"]
+    table[table.Key(0)]=g_kfilter
+
 # Build Data struct
 def __init__Func():
-    global database
-    database=sql.connect("./.cache/PacketInfo.db")
-    global cursor
-    cursor=database.cursor()
-    # cursor.execute("CREATE TABLE IF NOT EXISTS packets(time, netif, direction, length ,content, srcmac, dstmac, prot ,srcip, dstip, srcport, dstport)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS ipv6packets(time, netif, direction, length ,content, srcip, dstip, header ,srcport, dstport)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS ipv4packets(time, netif, direction, length ,content, srcip, dstip, srcport, dstport, prot, ipid, ttl, frag, option)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS otherpackets(time, netif, direction, length ,content)")
-    database.commit()
+    global writer
+    if StorageBackend=="memory":
+        # Only the last rows are kept, in memory, nothing is written under ./.cache
+        writer=RingWriter("./.cache/PacketInfo.db")
+    else:
+        database=sql.connect("./.cache/PacketInfo.db")
+        # cursor.execute("CREATE TABLE IF NOT EXISTS packets(time, netif, direction, length ,content, srcmac, dstmac, prot ,srcip, dstip, srcport, dstport)")
+        # ipv4packets/ipv6packets/otherpackets, typed and indexed
+        InitPacketSchema(database)
+        database.close()
+        # Only the writer thread touches the database from now on
+        writer=WriterThread("./.cache/PacketInfo.db")
+    writer.start()
     global netifname
     netifname=[]
     f=open("/proc/net/dev","r")
@@ -39,11 +135,6 @@ def __init__Func():
     # netifname=["ens33"]
     global start
     start = 0
-    global g_srcport,g_dstport,g_srcip,g_dstip
-    g_srcip=""
-    g_dstip=""
-    g_srcport=-1
-    g_dstport=-1
 
 
 def buildBPFSocketCounter():
@@ -51,7 +142,7 @@ def buildBPFSocketCounter():
     # socketTracertext=""
 
     global bpfTcxTracer,iprouter,attachtime
-    bpfTcxTracer=BPF(src_file="./tcxProber.c")
+    bpfTcxTracer=BPF(src_file="./tcxProber.c",cflags=RingCflags(EventRingPages))
     # https://docs.pyroute2.org/iproute_linux.html
     fn=bpfTcxTracer.load_func("tcx_ingress",BPF.SCHED_CLS)
     fn2=bpfTcxTracer.load_func("tcx_egress",BPF.SCHED_CLS)
@@ -72,113 +163,33 @@ def buildBPFSocketCounter():
         iprouter.tc("add-filter", "bpf", ens33, ":1",fd=fn.fd,name=fn.name,parent="ffff:", action="ok", classid=1)
         iprouter.tc("add", "sfq", ens33, "fffe:")
         iprouter.tc("add-filter", "bpf", ens33, ":1",fd=fn2.fd,name=fn2.name,parent="fffe:", action="ok", classid=1)
+    __ApplyKernelFilter()
+    __ApplyCaptureConfig()
     attachtime=time.time()
 
 
 
 def print_event(cpu,data,size):
-    global start
-    event = bpfTcxTracer["events"].event(data)
-    if start == 0:
-        start =event.timestamp
-    time_s=(float(event.timestamp-start))/1000000000
-    payloadlen = event.payloadlen
-    payload=event.payload[:payloadlen]
-    direction=event.direction
-    srcmac=payload[0:6]
-    dstmac=payload[6:12]
-    ethernetType=payload[12]*256+payload[13]
-    if ethernetType != 0x0800 and ethernetType != 0x86dd:
-        # Not IPv4 nor IPv6
-        cursor.execute("INSERT INTO otherpackets VALUES(?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload)))
-        return
-    prottype=payload[14]&0xf0
-    # subtype=payload[22]
-    # print(prottype)
-    if prottype == 64:
-        protip=4
-        # 1 ICMP 6 TCP 17 UDP
-        srcip=ArrayToIpv4(payload[26:30])
-        dstip=ArrayToIpv4(payload[30:34])
-        if (srcip!=g_srcip or dstip!=g_dstip) and (srcip!=g_dstip or dstip!=g_srcip) and (g_srcport>=0):
-            return
-        headerlen=(payload[14]&0x0f)*4
-        nextprotstart=headerlen+14
-        subprot=payload[23]
-        ttl=payload[22]
-        ipid=payload[19]+payload[18]*256
-        fragconfig=payload[20:22]
-        optionSeg=payload[34:nextprotstart]
-        # (time, netif, direction, length ,content, srcip, dstip, srcport, dstport, prot, ipid, ttl)
-        if subprot == 17 or subprot == 6:
-            # UDP or TCP 
-            srcport=payload[nextprotstart+1]+payload[nextprotstart]*256
-            dstport=payload[nextprotstart+3]+payload[nextprotstart+2]*256
-            if (srcport!=g_srcport or dstport!=g_dstport) and (g_srcport>=0):
-                return
-            cursor.execute("INSERT INTO ipv4packets VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload).hex(),srcip,dstip,srcport,dstport,subprot,ipid,ttl,bytes(fragconfig).hex(),bytes(optionSeg).hex()))
-        elif subprot == 1:
-            # ICMP
-            cursor.execute("INSERT INTO ipv4packets VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload).hex(),srcip,dstip,0,0,subprot,ipid,ttl,bytes(fragconfig).hex(),bytes(optionSeg).hex()))
-        #  extract TTL/ipid/Config
-        else:
-            cursor.execute("INSERT INTO otherpackets VALUES(?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload)))
-    elif prottype==96:
-        protip=6
-        headertype=payload[20]
-        srcip=ArrayToIpv6(payload[22:38])
-        dstip=ArrayToIpv6(payload[38:54])
-        if (srcip!=g_srcip or dstip!=g_dstip) and (srcip!=g_dstip or dstip!=g_srcip) and (g_srcport>=0):
-            return
-        if headertype == 6:
-            # TCP
-            srcport=payload[55]+payload[54]*256
-            dstport=payload[56]+payload[57]*256
-            if (srcport!=g_srcport or dstport!=g_dstport) and (srcport!=g_dstport or dstport!=g_srcport) and (g_srcport>=0):
-                return
-            cursor.execute("INSERT INTO ipv6packets VALUES(?,?,?,?,?,?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload).hex(),(srcip),(dstip),headertype,srcport,dstport))
-            return
-        if headertype == 17:
-            srcport=payload[55]+payload[54]*256
-            dstport=payload[56]+payload[57]*256
-            if (srcport!=g_srcport or dstport!=g_dstport) and (srcport!=g_dstport or dstport!=g_srcport) and (g_srcport>=0):
-                return
-            # UDP
-            cursor.execute("INSERT INTO ipv6packets VALUES(?,?,?,?,?,?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload).hex(),(srcip),(dstip),headertype,srcport,dstport))
-            return
-        # TODO : Append other headers/ Or do it in frontend?
-        if headertype == 58:
-            # ICMPv6
-            cursor.execute("INSERT INTO ipv6packets VALUES(?,?,?,?,?,?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload).hex(),(srcip),(dstip),headertype,0,0))
-        else:
-            cursor.execute("INSERT INTO otherpackets VALUES(?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload).hex()))
-            return
-        # For ipv6,it's necessary to commit and query how to get subsquent layer
-        # srcport=
-        # dstport=
-    else:
-        cursor.execute("INSERT INTO otherpackets VALUES(?,?,?,?,?)",(attachtime+time_s,0,direction,\
-            payloadlen,bytes(payload)))
-        # Not ipv4 Nor ipv6
+    # Only copy the record here, the ring buffer slot is released when we return
+    pending.append(CopyRecord(data,size))
+
+def DecodePending():
+    # Decode every record of the last poll at once (see PacketDecoder) and hand the rows to the writer
+    global start,pending,consumed
+    if not pending:
         return
-    # 96 = ipv6, 69 = ipv4
-    # srcip=""
-    # dstip=""
-    
-    # print(bytes(payload))
-    # Manually extract
-    # print("DestIP:"+daddr+" SendIP:"+saddr)
-    # print(payloadlen,attachtime+time_s)
-    # cursor.execute("INSERT INTO packets VALUES(?,?,?,?,?,?,?,?,?,?,?,?)",(attachtime+time_s,"ens33",direction,payloadlen,bytes(payload),bytes(srcmac),bytes(dstmac),protip,bytes(srcip),bytes(dstip),"",""))
-        # TODO Data Tramsmission
+    records=pending
+    pending=[]
+    consumed+=len(records)
+    if start == 0:
+        start=RecordTimestamp(records[0])
+    writer.insert_batch(DecodeRecords(records,attachtime,start))
+
+def GetRingStats():
+    # None until the prober is built
+    if "bpfTcxTracer" not in globals():
+        return None
+    return RingStats(bpfTcxTracer,EventRingPages,consumed,writer)
 
 
 def TcxProber(event):
@@ -188,7 +199,6 @@ def TcxProber(event):
     event.set()
     ringbuf = bpfTcxTracer.get_table("events")
     ringbuf.open_ring_buffer(print_event)
-    starttime=time.time()
     global clear_flag_tcx
     clear_flag_tcx=False
     
@@ -198,18 +208,14 @@ def TcxProber(event):
     # 
     while True:
         try:
-            if(time.time()-starttime>1):
-                starttime=time.time()
-                if clear_flag_tcx:
-                    # ipv4packets,ipv6packets,otherpackets
-                    cursor.execute("DELETE FROM ipv4packets WHERE time < {}".format(starttime))
-                    cursor.execute("DELETE FROM ipv6packets WHERE time < {}".format(starttime))
-                    cursor.execute("DELETE FROM otherpackets WHERE time < {}".format(starttime))
-                    # database.commit()
-                    clear_flag_tcx=False
-                database.commit()
-            # Not Commit TOO many times
-            bpfTcxTracer.ring_buffer_poll()
+            if clear_flag_tcx:
+                # DELETE runs on the writer thread, polling goes on meanwhile
+                writer.request_clear(["ipv4packets","ipv6packets","otherpackets"])
+                clear_flag_tcx=False
+            bpfTcxTracer.ring_buffer_poll(int(writer.maxdelay*1000))
+            DecodePending()
+            # Hand rows of this poll to the writer, never waits for disk
+            writer.submit()
         except KeyboardInterrupt:
             break
         finally:
@@ -222,18 +228,15 @@ if __name__ == "__main__":
 
     ringbuf = bpfTcxTracer.get_table("events")
     ringbuf.open_ring_buffer(print_event)
-    starttime=time.time()
     # print(t)
     # bpfTcxTracer["events"].open_perf_buffer(print_event,page_cnt=16)
     # bpfProgSocketCounter["eventsSend"].open_perf_buffer(print_event2)
     # 
     while True:
         try:
-            if(time.time()-starttime>1):
-                starttime=time.time()
-                database.commit()
-            # Not Commit TOO many times
-            bpfTcxTracer.ring_buffer_poll()
+            bpfTcxTracer.ring_buffer_poll(int(writer.maxdelay*1000))
+            DecodePending()
+            writer.submit()
         except KeyboardInterrupt:
             break
         finally:
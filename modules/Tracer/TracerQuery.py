@@ -0,0 +1,175 @@
+import heapq
+import queue
+import sqlite3 as sql
+from contextlib import contextmanager
+from itertools import islice
+from TracerSchema import ConfigureReader,ListBuckets,BucketOf,StorageBackend,AllTables,AddressColumns
+from IpAddress import PackAddress,FormatAddress,CanonicalAddress
+from RingStore import RingStore,GetStore,IterRows
+
+# Shared read side of FunctionInfo.db and PacketInfo.db for the Flask query modules.
+# Every statement uses bound parameters, so its text is constant and sqlite3
+# reuses the prepared statement from the per-connection cache.
+# The databases are in WAL mode, a read sees the last committed batch and never blocks the writer.
+# Tables are split in time buckets (see TracerSchema), a query runs once per overlapping bucket.
+# With the memory backend ReadConnection hands out the RingStore instead, and every
+# function below answers the same call with a mask scan over the ring.
+
+FunctionDB="./.cache/FunctionInfo.db"
+PacketDB="./.cache/PacketInfo.db"
+# Prepared statements kept per connection, each bucket has its own statement text
+StatementCacheSize=1024
+# Idle read connections kept per database
+PoolSize=8
+
+# path -> LifoQueue of idle connections
+__pools={}
+
+def __OpenReadConnection(path):
+    # Connections move between Flask request threads, but only one thread uses one at a time
+    database=sql.connect(path,cached_statements=StatementCacheSize,check_same_thread=False)
+    ConfigureReader(database)
+    return database
+
+@contextmanager
+def ReadConnection(path):
+    if StorageBackend=="memory":
+        # Read in place, there is no connection to pool
+        yield GetStore(path)
+        return
+    pool=__pools.setdefault(path,queue.LifoQueue(PoolSize))
+    try:
+        database=pool.get_nowait()
+    except queue.Empty:
+        database=__OpenReadConnection(path)
+    # One snapshot for the whole request, so buckets listed by ListBuckets
+    # cannot be dropped by retention before they are read
+    database.execute("BEGIN")
+    try:
+        yield database
+    finally:
+        # End the read transaction so its snapshot does not hold back checkpoints
+        database.rollback()
+        try:
+            pool.put_nowait(database)
+        except queue.Full:
+            database.close()
+
+def ScanBuckets(database,table,columns,where,params,since=None,until=None,tail="",newest=False):
+    # Rows of SELECT columns FROM <bucket> WHERE where tail, over the buckets of table overlapping
+    # [since, until], oldest bucket first or newest first. A bucket is only queried once reached,
+    # so a caller that stops early never touches the older (or newer) ones.
+    low=None if since is None else BucketOf(since)
+    high=None if until is None else BucketOf(until)
+    buckets=ListBuckets(database,table)
+    if newest:
+        buckets.reverse()
+    for bucket,_,name in buckets:
+        if (low is not None and bucket<low) or (high is not None and bucket>high):
+            continue
+        yield from database.execute("SELECT {} FROM {} WHERE {}{}".format(columns,name,where,tail),params)
+
+def __FlowConds(srcport,dstport,srcip,dstip):
+    return [("srcport","==",int(srcport)),("dstport","==",int(dstport)),("srcip","==",srcip),("dstip","==",dstip)]
+
+def __AddressSlots(table):
+    names=[item.split()[0] for item in AllTables[table].split(",")]
+    return [names.index(column) for column in AddressColumns.get(table,())]
+
+def __FormatAddresses(table,rows):
+    # Packed srcip/dstip of the returned rows only -> text
+    slots=__AddressSlots(table)
+    result=[]
+    for row in rows:
+        row=list(row)
+        for slot in slots:
+            row[slot]=FormatAddress(row[slot])
+        result.append(tuple(row))
+    return result
+
+def FlowPackets(database,table,srcport,dstport,srcip,dstip,limit=None):
+    # One direction of a flow, table is ipv4packets or ipv6packets
+    # With limit, only the newest rows come back, newest first
+    try:
+        srcip=PackAddress(srcip)
+        dstip=PackAddress(dstip)
+    except OSError:
+        # Not an address, nothing can match
+        return []
+    if isinstance(database,RingStore):
+        rows=database.select(table,__FlowConds(srcport,dstport,srcip,dstip),
+                             order=None if limit is None else "desc",limit=limit).tolist()
+        return __FormatAddresses(table,rows)
+    where="srcport = ? and dstport = ? and srcip = ? and dstip = ?"
+    params=[int(srcport),int(dstport),srcip,dstip]
+    if limit is None:
+        return __FormatAddresses(table,ScanBuckets(database,table,"*",where,params))
+    rows=ScanBuckets(database,table,"*",where,params+[limit],tail=" ORDER BY time DESC LIMIT ?",newest=True)
+    return __FormatAddresses(table,islice(rows,limit) if limit>=0 else rows)
+
+def FlowSpecCalls(database,ids,srcport,dstport,srcip,dstip,since=None,limit=None):
+    # SpecfunctionCall entries of the given IDs for one direction of a flow, optionally after since
+    # With limit, only the newest rows come back, newest first
+    # Addresses are stored in canonical text, any spelling of them matches
+    srcip=CanonicalAddress(srcip)
+    dstip=CanonicalAddress(dstip)
+    if isinstance(database,RingStore):
+        conds=[("ID","in",ids)]+__FlowConds(srcport,dstport,srcip,dstip)
+        if since is not None:
+            conds.append(("time",">",since))
+        return database.select("SpecfunctionCall",conds,order=None if limit is None else "desc",limit=limit).tolist()
+    where="ID in ({}) and srcport = ? and dstport = ? and srcip = ? and dstip = ?".format(",".join("?"*len(ids)))
+    params=list(ids)+[int(srcport),int(dstport),srcip,dstip]
+    if since is not None:
+        where+=" and time > ?"
+        params.append(since)
+    if limit is None:
+        return list(ScanBuckets(database,"SpecfunctionCall","*",where,params,since=since))
+    rows=ScanBuckets(database,"SpecfunctionCall","*",where,params+[limit],since=since,
+                     tail=" ORDER BY time DESC LIMIT ?",newest=True)
+    return list(islice(rows,limit)) if limit>=0 else list(rows)
+
+def ThreadCalls(database,pid,since):
+    # (time, isRet, ID, PID) of every functionCall row of pid from since on, by time, produced lazily
+    if isinstance(database,RingStore):
+        return IterRows(database.select("functionCall",[("PID","==",pid),("time",">=",since)],
+                                        columns=("time","isRet","ID","PID"),order="asc"))
+    return ScanBuckets(database,"functionCall","time,isRet,ID,PID","PID = ? and time >= ?",(pid,since),
+                       since=since,tail=" ORDER BY time")
+
+def LastListenCall(database,pid,before):
+    # Time of the last 30000x entry of pid strictly before before, or None
+    if isinstance(database,RingStore):
+        rows=database.select("SpecfunctionCall",[("ID",">",299999),("PID","==",pid),("time","<",before)],
+                             columns=("time",),order="desc",limit=1).tolist()
+    else:
+        rows=ScanBuckets(database,"SpecfunctionCall","time","ID > 299999 and PID = ? and time < ?",(pid,before),
+                         until=before,tail=" ORDER BY time DESC LIMIT 1",newest=True)
+    first=next(iter(rows),None)
+    return None if first is None else first[0]
+
+def ListenCalls(database,pid,since,until):
+    # SpecfunctionCall 30000x entries of pid with since <= time < until, by time, produced lazily
+    if isinstance(database,RingStore):
+        return IterRows(database.select("SpecfunctionCall",[("ID",">",299999),("PID","==",pid),("time",">=",since),
+                                                            ("time","<",until)],order="asc"))
+    return ScanBuckets(database,"SpecfunctionCall","*","ID > 299999 and PID = ? and time >= ? and time < ?",
+                       (pid,since,until),since=since,until=until,tail=" ORDER BY time")
+
+def __MergeNewest(directions,count):
+    # Each direction is newest first and at most count long, keep the newest count overall
+    merged=heapq.merge(*directions,key=lambda row:row[0],reverse=True)
+    return list(islice(merged,count)) if count>0 else list(merged)
+
+def RecentFlowPackets(database,table,srcport,dstport,srcip,dstip,count):
+    # Newest count packets of both directions, newest first; count <= 0 means all
+    # Each direction is an ORDER BY time DESC LIMIT scan of the flow index
+    limit=count if count>0 else -1
+    return __MergeNewest([FlowPackets(database,table,srcport,dstport,srcip,dstip,limit),
+                          FlowPackets(database,table,dstport,srcport,dstip,srcip,limit)],count)
+
+def RecentFlowSpecCalls(database,ids,srcport,dstport,srcip,dstip,count,since=None):
+    # Newest count SpecfunctionCall entries of both directions, newest first; count <= 0 means all
+    limit=count if count>0 else -1
+    return __MergeNewest([FlowSpecCalls(database,ids,srcport,dstport,srcip,dstip,since,limit),
+                          FlowSpecCalls(database,ids,dstport,srcport,dstip,srcip,since,limit)],count)
@@ -0,0 +1,195 @@
+import os
+import sqlite3 as sql
+from IpAddress import PackAddress,CanonicalAddress
+
+# Storage backend chosen at startup: "sqlite" keeps the capture in ./.cache/*.db,
+# "memory" keeps only the last rows of each table in RingStore
+StorageBackend=os.environ.get("TRACER_STORAGE","sqlite")
+
+# Bump when tables or indexes below change, kept in PRAGMA user_version
+SchemaVersion=4
+
+# Every table below is stored as one table per time bucket, named <table>_<bucket>
+# with bucket = int(time // BucketSeconds), so retention drops whole tables
+# and queries only touch the buckets overlapping their time range.
+BucketSeconds=60
+
+# Both databases are written by a WriterThread while Flask reads them.
+# In WAL mode readers keep their snapshot while the writer appends, so neither blocks the other.
+# synchronous=NORMAL only fsyncs at checkpoints, a power loss can cost the last commits but never corrupts.
+# Automatic checkpoints are off, WriterThread runs them itself between batches.
+MmapSize=256*1024*1024
+# WAL file is truncated back to this size after a checkpoint
+JournalSizeLimit=64*1024*1024
+# Milliseconds to wait on a lock instead of raising OperationalError
+WriterBusyTimeout=5000
+ReaderBusyTimeout=2000
+
+FunctionTables={
+    "functionCall":"time REAL NOT NULL, isRet INTEGER NOT NULL, ID INTEGER NOT NULL, PID INTEGER NOT NULL",
+    "SpecfunctionCall":"time REAL NOT NULL, isRet INTEGER NOT NULL, ID INTEGER NOT NULL, PID INTEGER NOT NULL, "
+                       "family INTEGER, srcport INTEGER, dstport INTEGER, srcip TEXT, dstip TEXT, pkt BLOB",
+}
+
+# Indexes are created on every bucket, named <index>_<bucket>
+# Access paths of QueryAndGetFuncMapSend/Recv and GetRecentMaps:
+# window by (PID, time), matching return by (ID, isRet, PID, time), flow lookup on SpecfunctionCall
+FunctionIndexes={
+    "functionCall_pid_time":("functionCall","PID, time"),
+    "functionCall_id_ret_pid_time":("functionCall","ID, isRet, PID, time"),
+    "SpecfunctionCall_flow":("SpecfunctionCall","srcip, dstip, srcport, dstport, time"),
+    "SpecfunctionCall_pid_time":("SpecfunctionCall","PID, time"),
+}
+
+PacketTables={
+    "ipv4packets":"time REAL NOT NULL, netif INTEGER, direction INTEGER, length INTEGER, content BLOB, "
+                  "srcip BLOB, dstip BLOB, srcport INTEGER, dstport INTEGER, prot INTEGER, "
+                  "ipid INTEGER, ttl INTEGER, frag BLOB, option BLOB",
+    "ipv6packets":"time REAL NOT NULL, netif INTEGER, direction INTEGER, length INTEGER, content BLOB, "
+                  "srcip BLOB, dstip BLOB, header INTEGER, srcport INTEGER, dstport INTEGER",
+    "otherpackets":"time REAL NOT NULL, netif INTEGER, direction INTEGER, length INTEGER, content BLOB",
+}
+
+# Access path of TcxQuery and GetRecentPackets
+PacketIndexes={
+    "ipv4packets_flow":("ipv4packets","srcip, dstip, srcport, dstport, time"),
+    "ipv6packets_flow":("ipv6packets","srcip, dstip, srcport, dstport, time"),
+    "otherpackets_time":("otherpackets","time"),
+}
+
+AllTables={**FunctionTables,**PacketTables}
+AllIndexes={**FunctionIndexes,**PacketIndexes}
+
+# Packet addresses are stored packed (4 or 16 bytes, network order) as the capture
+# thread cut them out of the header, and only turned into text for returned rows
+AddressColumns={
+    "ipv4packets":("srcip","dstip"),
+    "ipv6packets":("srcip","dstip"),
+}
+# Addresses kept as text, in the canonical form of IpAddress.FormatAddress since schema 4
+TextAddressColumns={
+    "SpecfunctionCall":("srcip","dstip"),
+}
+
+def __ColumnNames(columns):
+    return [item.split()[0] for item in columns.split(",")]
+
+def BucketOf(timestamp):
+    return int(timestamp//BucketSeconds)
+
+def BucketTable(table,bucket):
+    return "{}_{}".format(table,bucket)
+
+def __SplitBucketTable(name):
+    # (table, bucket) for a bucket table name, None for anything else
+    table,_,bucket=name.rpartition("_")
+    if table not in AllTables or not bucket.isdigit():
+        return None
+    return table,int(bucket)
+
+def ListBuckets(database,table=None):
+    # Sorted (bucket, table, name) of the existing bucket tables, of one table or of all
+    result=[]
+    for (name,) in database.execute("SELECT name FROM sqlite_master WHERE type='table'"):
+        split=__SplitBucketTable(name)
+        if split is not None and (table is None or split[0]==table):
+            result.append((split[1],split[0],name))
+    result.sort()
+    return result
+
+def CreateBucket(database,table,bucket):
+    name=BucketTable(table,bucket)
+    database.execute("CREATE TABLE IF NOT EXISTS {}({})".format(name,AllTables[table]))
+    for index,(indexTable,columns) in AllIndexes.items():
+        if indexTable==table:
+            database.execute("CREATE INDEX IF NOT EXISTS {}_{} ON {}({})".format(index,bucket,name,columns))
+    return name
+
+def __CopyColumns(table,version):
+    # Column list to select when copying rows written under an older schema
+    columns=[]
+    for name in __ColumnNames(AllTables[table]):
+        if version<3 and name in AddressColumns.get(table,()):
+            # Text addresses before schema 3
+            name="PackAddress({})".format(name)
+        elif version<4 and name in TextAddressColumns.get(table,()):
+            # Uncompressed IPv6 text before schema 4
+            name="CanonicalAddress({})".format(name)
+        columns.append(name)
+    return columns
+
+def __NeedsRewrite(table,version):
+    # Bucket tables (schema 2 on) whose column values changed form since version
+    return version>=2 and ((version<3 and table in AddressColumns) or (version<4 and table in TextAddressColumns))
+
+def __MigrateTable(database,table,version):
+    # Spread the rows of an unbucketed table (schema 0 or 1) into bucket tables
+    names=",".join(__ColumnNames(AllTables[table]))
+    columns=",".join(__CopyColumns(table,version))
+    buckets=[item[0] for item in database.execute(
+        "SELECT DISTINCT CAST(time / ? AS INTEGER) FROM {}".format(table),(BucketSeconds,)).fetchall()]
+    for bucket in buckets:
+        name=CreateBucket(database,table,bucket)
+        database.execute("INSERT INTO {0}({1}) SELECT {2} FROM {3} WHERE time >= ? and time < ?".format(name,names,columns,table),
+                         (bucket*BucketSeconds,(bucket+1)*BucketSeconds))
+    database.execute("DROP TABLE {}".format(table))
+
+def __RewriteBucket(database,table,bucket,name,version):
+    # Copy a bucket into the current column types, then rebuild its indexes
+    names=",".join(__ColumnNames(AllTables[table]))
+    database.execute("CREATE TABLE {}_new({})".format(name,AllTables[table]))
+    database.execute("INSERT INTO {0}_new({1}) SELECT {2} FROM {0}".format(name,names,",".join(__CopyColumns(table,version))))
+    database.execute("DROP TABLE {}".format(name))
+    database.execute("ALTER TABLE {0}_new RENAME TO {0}".format(name))
+    CreateBucket(database,table,bucket)
+
+def __PackAddress(value):
+    try:
+        return PackAddress(value)
+    except (OSError,ValueError,TypeError):
+        # Not an address, keep it as it is
+        return value
+
+def __CreateSchema(database,tables):
+    ConfigureWriter(database)
+    cursor=database.cursor()
+    version=cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version<SchemaVersion:
+        # Dropped buckets give their pages back through incremental_vacuum,
+        # switching an existing file needs one VACUUM
+        vacuum=cursor.execute("PRAGMA auto_vacuum").fetchone()[0]!=2
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        database.create_function("PackAddress",1,__PackAddress,deterministic=True)
+        database.create_function("CanonicalAddress",1,CanonicalAddress,deterministic=True)
+        for table in tables:
+            exists=cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",(table,)).fetchone()
+            if exists:
+                __MigrateTable(database,table,version)
+            elif __NeedsRewrite(table,version):
+                for bucket,_,name in ListBuckets(database,table):
+                    __RewriteBucket(database,table,bucket,name,version)
+        cursor.execute("PRAGMA user_version = {}".format(SchemaVersion))
+        database.commit()
+        if vacuum:
+            cursor.execute("VACUUM")
+    cursor.close()
+
+def ConfigureWriter(database):
+    # journal_mode is kept in the database file, the rest is per connection
+    database.execute("PRAGMA journal_mode=WAL")
+    database.execute("PRAGMA synchronous=NORMAL")
+    database.execute("PRAGMA wal_autocheckpoint=0")
+    database.execute("PRAGMA journal_size_limit={}".format(JournalSizeLimit))
+    database.execute("PRAGMA mmap_size={}".format(MmapSize))
+    database.execute("PRAGMA busy_timeout={}".format(WriterBusyTimeout))
+
+def ConfigureReader(database):
+    database.execute("PRAGMA query_only=1")
+    database.execute("PRAGMA mmap_size={}".format(MmapSize))
+    database.execute("PRAGMA busy_timeout={}".format(ReaderBusyTimeout))
+
+def InitFunctionSchema(database):
+    __CreateSchema(database,FunctionTables)
+
+def InitPacketSchema(database):
+    __CreateSchema(database,PacketTables)
@@ -4,6 +4,7 @@ import subprocess
 from ListSockets import ListAll
 from ReadBTFandGetItsMember import ReadBTFandGetItsMember
 from translateJSON import translateJSON
+import CompileCache
 import TcxProber
 from TcxQuery import TcxQuery
 import AttachAndRunProbers
@@ -11,6 +12,7 @@ from QueryAndGetFuncMapRecv import QueryAndGetFuncMapRecv
 from QueryAndGetFuncMapSend import QueryAndGetFuncMapSend
 from GetRecentMaps import GetRecentMaps
 from GetRecentPackets import GetRecentPackets
+from PSUtil import BlobEncodings
 import sqlite3
 import threading
 import json
@@ -29,6 +31,16 @@ def IsAttachFinished():
         return json.dumps([False])
 
 
+def __FormPorts():
+    # srcport/dstport of the form as integers, ValueError for anything else
+    ports=[]
+    for name in ("srcport","dstport"):
+        try:
+            ports.append(int(request.form[name]))
+        except ValueError:
+            raise ValueError("{} must be an integer, not {!r}".format(name,request.form[name]))
+    return ports
+
 @mainApp.route("/GetRecentPacket",methods=["GET","POST"])
 def GetRecentPacket():
     method = request.method
@@ -36,14 +48,23 @@ def GetRecentPacket():
         return "QueryFuncSend, Please Use POST",400
     src_ip=request.form["srcip"]
     dst_ip=request.form["dstip"]
-    src_port=request.form["srcport"]
-    dst_port=request.form["dstport"]
+    try:
+        src_port,dst_port=__FormPorts()
+    except ValueError as e:
+        return "Illegal port: {}".format(e),400
     ipver=request.form["ipver"]
-    limit=int(request.form["count"])
     try:
-        result=GetRecentPackets(src_port,dst_port,src_ip,dst_ip,ipver,limit)
-    except sqlite3.OperationalError:
-        DeleteHistData()
+        limit=int(request.form["count"])
+    except ValueError:
+        return "Illegal count: {!r}".format(request.form["count"]),400
+    encoding=request.form.get("encoding","hex")
+    if encoding not in BlobEncodings:
+        return "Illegal encoding, use one of {}".format(",".join(BlobEncodings)),400
+    try:
+        result=GetRecentPackets(src_port,dst_port,src_ip,dst_ip,ipver,limit,encoding)
+    except sqlite3.OperationalError as e:
+        # Busy or locked database, the capture is kept and the query can be retried
+        print("[LOG]Query failed: {}".format(e))
         return []
     return result
 
@@ -54,17 +75,23 @@ def GetRecentMap():
         return "QueryFuncSend, Please Use POST",400
     src_ip=request.form["srcip"]
     dst_ip=request.form["dstip"]
-    src_port=request.form["srcport"]
-    dst_port=request.form["dstport"]
-    limit=int(request.form["count"])
+    try:
+        src_port,dst_port=__FormPorts()
+    except ValueError as e:
+        return "Illegal port: {}".format(e),400
+    try:
+        limit=int(request.form["count"])
+    except ValueError:
+        return "Illegal count: {!r}".format(request.form["count"]),400
     try:
         tlimit=float(request.form["timeDownLimit"])
     except BaseException:
         tlimit=-1
     try:
         result=GetRecentMaps(src_port,dst_port,src_ip,dst_ip,limit,tlimit)
-    except sqlite3.OperationalError:
-        DeleteHistData()
+    except sqlite3.OperationalError as e:
+        # Busy or locked database, the capture is kept and the query can be retried
+        print("[LOG]Query failed: {}".format(e))
         return []
     return result
 
@@ -77,30 +104,77 @@ def SetFilter():
     dst_ip=request.form["dstip"]
     src_port=request.form["srcport"]
     dst_port=request.form["dstport"]
-    TcxProber.g_srcip=src_ip
-    TcxProber.g_dstip=dst_ip
-    TcxProber.g_dstport=int(dst_port)
-    TcxProber.g_srcport=int(src_port)
-    AttachAndRunProbers.g_srcip=src_ip
-    AttachAndRunProbers.g_dstip=dst_ip
-    AttachAndRunProbers.g_dstport=int(dst_port)
-    AttachAndRunProbers.g_srcport=int(src_port)
-    AttachAndRunProbers.g_status=0
+    prot=request.form.get("prot",0)
+    try:
+        TcxProber.SetKernelFilter(src_ip,dst_ip,src_port,dst_port,prot)
+    except (OSError,ValueError) as e:
+        return "Illegal Filter: {}".format(e),400
+    AttachAndRunProbers.SetFlowFilter(src_ip,dst_ip,src_port,dst_port)
     return "Filter Set!"
 
+@mainApp.route("/SetSnapLen",methods=["GET","POST"])
+def SetSnapLen():
+    method = request.method
+    if method == "GET":
+        return "SetSnapLen, Please Use POST",400
+    try:
+        snaplen=TcxProber.SetSnapLen(request.form["snaplen"])
+    except ValueError as e:
+        return "Illegal SnapLen: {}".format(e),400
+    return json.dumps([snaplen])
+
 @mainApp.route("/UnsetFilter",methods=["GET"])
 def UnsetFilter():
-    TcxProber.g_srcip=""
-    TcxProber.g_dstip=""
-    TcxProber.g_dstport=-1
-    TcxProber.g_srcport=-1
-    AttachAndRunProbers.g_srcip=""
-    AttachAndRunProbers.g_dstip=""
-    AttachAndRunProbers.g_dstport=-1
-    AttachAndRunProbers.g_srcport=-1
-    AttachAndRunProbers.g_status=0
+    TcxProber.UnsetKernelFilter()
+    AttachAndRunProbers.UnsetFlowFilter()
     return "Filter Unset!"
 
+@mainApp.route("/SetCallMode",methods=["GET","POST"])
+def SetCallMode():
+    method = request.method
+    if method == "GET":
+        return json.dumps([AttachAndRunProbers.CallMode])
+    try:
+        AttachAndRunProbers.SetCallMode(request.form["mode"])
+    except ValueError as e:
+        return "Illegal Mode: {}".format(e),400
+    return "Mode Set!"
+
+@mainApp.route("/SetFuncEnabled",methods=["GET","POST"])
+def SetFuncEnabled():
+    method = request.method
+    if method == "GET":
+        return json.dumps(AttachAndRunProbers.GetDisabledFuncs())
+    funcs=request.form.get("funcs","").split(",")
+    keyword=request.form.get("keyword","")
+    enabled=request.form.get("enabled","true").lower()=="true"
+    try:
+        funcids=AttachAndRunProbers.SelectFuncs(funcs,keyword)
+    except ValueError as e:
+        return "Illegal Function: {}".format(e),400
+    AttachAndRunProbers.SetFuncsEnabled(funcids,enabled)
+    return json.dumps(sorted(funcids))
+
+@mainApp.route("/SetThrottle",methods=["GET","POST"])
+def SetThrottle():
+    method = request.method
+    if method == "GET":
+        return json.dumps(AttachAndRunProbers.GetThrottleState())
+    try:
+        AttachAndRunProbers.SetThrottle(request.form["budget"],request.form.get("policy",AttachAndRunProbers.ThrottlePolicy))
+    except ValueError as e:
+        return "Illegal Throttle: {}".format(e),400
+    return "Throttle Set!"
+
+@mainApp.route("/GetFuncLatency",methods=["GET"])
+def GetFuncLatency():
+    return json.dumps(AttachAndRunProbers.GetFuncLatency())
+
+@mainApp.route("/Stats",methods=["GET"])
+def Stats():
+    # Ring buffer accounting per probe, null for a probe not built yet
+    return json.dumps({"tcx":TcxProber.GetRingStats(),"func":AttachAndRunProbers.GetRingStats()})
+
 @mainApp.route("/ClearData",methods=["GET"])
 def DeleteHistData():
     TcxProber.clear_flag_tcx=True
@@ -122,14 +196,17 @@ def QueryFuncSend():
         return "QueryFuncSend, Please Use POST",400
     src_ip=request.form["srcip"]
     dst_ip=request.form["dstip"]
-    src_port=request.form["srcport"]
-    dst_port=request.form["dstport"]
+    try:
+        src_port,dst_port=__FormPorts()
+    except ValueError as e:
+        return "Illegal port: {}".format(e),400
     # subprocess.Popen()
     # subprocess.run()
     try:
         result = QueryAndGetFuncMapSend(src_port,dst_port,src_ip,dst_ip)
-    except sqlite3.OperationalError:
-        DeleteHistData()
+    except sqlite3.OperationalError as e:
+        # Busy or locked database, the capture is kept and the query can be retried
+        print("[LOG]Query failed: {}".format(e))
         return []
     return result
 
@@ -140,12 +217,15 @@ def QueryFuncRecv():
         return "QueryFuncSend, Please Use POST",400
     src_ip=request.form["srcip"]
     dst_ip=request.form["dstip"]
-    src_port=request.form["srcport"]
-    dst_port=request.form["dstport"]
+    try:
+        src_port,dst_port=__FormPorts()
+    except ValueError as e:
+        return "Illegal port: {}".format(e),400
     try:
         result = QueryAndGetFuncMapRecv(src_port,dst_port,src_ip,dst_ip)
-    except sqlite3.OperationalError:
-        DeleteHistData()
+    except sqlite3.OperationalError as e:
+        # Busy or locked database, the capture is kept and the query can be retried
+        print("[LOG]Query failed: {}".format(e))
         return []
     return result
 
@@ -156,14 +236,20 @@ def QueryPacket():
         return "QueryFuncSend, Please Use POST",400
     src_ip=request.form["srcip"]
     dst_ip=request.form["dstip"]
-    src_port=request.form["srcport"]
-    dst_port=request.form["dstport"]
+    try:
+        src_port,dst_port=__FormPorts()
+    except ValueError as e:
+        return "Illegal port: {}".format(e),400
     ipver=request.form["ipver"]
+    encoding=request.form.get("encoding","hex")
+    if encoding not in BlobEncodings:
+        return "Illegal encoding, use one of {}".format(",".join(BlobEncodings)),400
     # subprocess.Popen()
     try:
-        result = TcxQuery(src_port,dst_port,src_ip,dst_ip,ipver)
-    except sqlite3.OperationalError:
-        DeleteHistData()
+        result = TcxQuery(src_port,dst_port,src_ip,dst_ip,ipver,encoding)
+    except sqlite3.OperationalError as e:
+        # Busy or locked database, the capture is kept and the query can be retried
+        print("[LOG]Query failed: {}".format(e))
         return []
     return result
 
@@ -182,14 +268,20 @@ if __name__ == "__main__":
         os.remove("./.cache/PacketInfo.db")
     bcc._probe_limit=20000
     bcc._default_probe_limit=20000
-    # bpftool -j btf dump file /sys/kernel/btf/vmlinux > ./btf.json
-    subprocess.run(["rm","-f","./.cache/btf.json"])
-    fo=open("./.cache/btf.json","x")
-    subprocess.run(["bpftool","-j","btf","dump","file","/sys/kernel/btf/vmlinux"],stdout=fo)
-    # subprocess.run(["ulimit","-n","32768"],shell=True)
-    # ulimit -n 32768
-    ReadBTFandGetItsMember()
-    translateJSON()
+    # The related functions and the generated probe source are reused while kernel, generators and options stay the same
+    fentry=AttachAndRunProbers.UseFentry()
+    generatedKey=CompileCache.BuildKey(["ReadBTFandGetItsMember.py","BTFReader.py","translateJSON.py"],fentry=fentry)
+    generated=["./.cache/relatedFuncD5.json","./.cache/FuncIDMap.json","./.cache/kProberFunc.c"]
+    if CompileCache.IsFresh("kProberFunc",generatedKey,generated):
+        print("[LOG]Reusing generated probes in ./.cache")
+    else:
+        CompileCache.Invalidate("kProberFunc")
+        # Analyses BTF only when the kernel or the analysis changed since the last run
+        # subprocess.run(["ulimit","-n","32768"],shell=True)
+        # ulimit -n 32768
+        ReadBTFandGetItsMember()
+        translateJSON(fentry=fentry)
+        CompileCache.MarkFresh("kProberFunc",generatedKey)
     contEvent = threading.Event()
     TcxThread=threading.Thread(target=TcxProber.TcxProber,args=(contEvent,),daemon=True)
     TcxThread.start()
@@ -2,6 +2,10 @@
 #include <net/sock.h>
 #include <linux/sched.h>
 #include <linux/uio.h>
+#include <uapi/linux/if_ether.h>
+#include <uapi/linux/ip.h>
+#include <uapi/linux/ipv6.h>
+#include <uapi/linux/in.h>
 // #include <vmlinux.h>
 // #include <bpf/bpf_helpers.h>
 // #include <bpf/bpf_core_read.h>
@@ -14,7 +18,42 @@
 
 // Ref:https://github.com/iovisor/bcc/blob/1dcfcec51c89713d243247ad7abea654a6dc7b20/examples/networking/simple_tc.py#L22
 // examples/networking/simple_tc.py
-BPF_RINGBUF_OUTPUT(events, 128);
+// Pages of the ring, TcxProber passes -DEVENTS_RING_PAGES from TRACER_TCX_RING_PAGES
+#ifndef EVENTS_RING_PAGES
+#define EVENTS_RING_PAGES 128
+#endif
+BPF_RINGBUF_OUTPUT(events, EVENTS_RING_PAGES);
+
+// Per CPU ring accounting for /Stats: records submitted, and records lost because the ring was full
+#define RING_SUBMITTED 0
+#define RING_DROPPED 1
+BPF_PERCPU_ARRAY(ring_stats, u64, 2);
+
+static __always_inline void
+count_ring(u32 slot)
+{
+    u64 *value = ring_stats.lookup(&slot);
+    if (value != NULL)
+    {
+        *value += 1;
+    }
+}
+
+// Five-tuple filter written by TcxProber.SetKernelFilter (/SetFilter)
+// Zero address / port / prot / family means wildcard for that field
+// Matched in both directions, checked before ringbuf_reserve
+struct flow_filter
+{
+    u32 enabled;
+    u32 family;
+    u32 prot;
+    u16 sport;
+    u16 dport;
+    // IPv4 uses saddr[0]/daddr[0], network order
+    u32 saddr[4];
+    u32 daddr[4];
+};
+BPF_ARRAY(flow_filter, struct flow_filter, 1);
 
 struct packet_metadata
 {
@@ -30,19 +69,195 @@ struct packet_metadata
     // Four-Ele Set for Specification
     u64 timestamp;
     u64 netifidx;
+    // Length on wire, caplen bytes follow this header
     u64 payloadlen;
+    u64 caplen;
     // u64 pid;
     // char comm[TASK_COMM_LEN];
-    u8 payload[6144];
 };
 
+// Record size classes, picked through capture_config by TcxProber.SetSnapLen
+// Header class keeps L2-L4 (eth + ipv4 with options + ports), ~128 bytes
+#define SNAP_CLASS_HEADER 0
+#define SNAP_CLASS_MEDIUM 1
+#define SNAP_CLASS_FULL 2
+#define SNAP_HEADER_LEN 128
+#define SNAP_MEDIUM_LEN 512
+#define SNAP_FULL_LEN 6144
+
+struct packet_record_header
+{
+    struct packet_metadata meta;
+    u8 payload[SNAP_HEADER_LEN];
+};
+
+struct packet_record_medium
+{
+    struct packet_metadata meta;
+    u8 payload[SNAP_MEDIUM_LEN];
+};
+
+struct packet_record_full
+{
+    struct packet_metadata meta;
+    u8 payload[SNAP_FULL_LEN];
+};
+
+struct capture_config
+{
+    u32 snapclass;
+    // Bytes actually copied, never larger than the class
+    u32 snaplen;
+};
+BPF_ARRAY(capture_config, struct capture_config, 1);
+
 // struct packet_payload
 // {
 // }
 
+static __always_inline bool
+addr_is_any(const u32 *addr)
+{
+    return (addr[0] | addr[1] | addr[2] | addr[3]) == 0;
+}
+
+static __always_inline bool
+addr_equal(const u32 *a, const u32 *b)
+{
+    return a[0] == b[0] && a[1] == b[1] && a[2] == b[2] && a[3] == b[3];
+}
+
+static __always_inline bool
+flow_side_match(struct flow_filter *f, const u32 *src, const u32 *dst,
+                u16 sport, u16 dport, bool has_ports)
+{
+    if (!addr_is_any(f->saddr) && !addr_equal(f->saddr, src))
+        return false;
+    if (!addr_is_any(f->daddr) && !addr_equal(f->daddr, dst))
+        return false;
+    if (!has_ports)
+        return true;
+    if (f->sport && f->sport != sport)
+        return false;
+    if (f->dport && f->dport != dport)
+        return false;
+    return true;
+}
+
+// true -> packet goes to ring buffer
+static __always_inline bool
+flow_filter_pass(struct __sk_buff *skb)
+{
+    int zero = 0;
+    struct flow_filter *f = flow_filter.lookup(&zero);
+    if (f == NULL || !f->enabled)
+    {
+        return true;
+    }
+    u16 eth_proto = 0;
+    if (bpf_skb_load_bytes(skb, 12, &eth_proto, sizeof(eth_proto)) < 0)
+    {
+        return false;
+    }
+    u32 src[4] = {};
+    u32 dst[4] = {};
+    u32 family = 0;
+    u32 prot = 0;
+    u32 l4off = 0;
+    if (eth_proto == bpf_htons(ETH_P_IP))
+    {
+        struct iphdr iph;
+        if (bpf_skb_load_bytes(skb, ETH_HLEN, &iph, sizeof(iph)) < 0)
+        {
+            return false;
+        }
+        family = 4;
+        prot = iph.protocol;
+        src[0] = iph.saddr;
+        dst[0] = iph.daddr;
+        l4off = ETH_HLEN + iph.ihl * 4;
+    }
+    else if (eth_proto == bpf_htons(ETH_P_IPV6))
+    {
+        struct ipv6hdr ip6h;
+        if (bpf_skb_load_bytes(skb, ETH_HLEN, &ip6h, sizeof(ip6h)) < 0)
+        {
+            return false;
+        }
+        family = 6;
+        prot = ip6h.nexthdr;
+        __builtin_memcpy(src, &ip6h.saddr, sizeof(src));
+        __builtin_memcpy(dst, &ip6h.daddr, sizeof(dst));
+        l4off = ETH_HLEN + sizeof(ip6h);
+    }
+    else
+    {
+        // Not IPv4 nor IPv6, can not match a five-tuple
+        return false;
+    }
+    if (f->family && f->family != family)
+    {
+        return false;
+    }
+    if (f->prot && f->prot != prot)
+    {
+        return false;
+    }
+    u16 sport = 0;
+    u16 dport = 0;
+    bool has_ports = (prot == IPPROTO_TCP || prot == IPPROTO_UDP);
+    if (has_ports)
+    {
+        u16 ports[2];
+        if (bpf_skb_load_bytes(skb, l4off, ports, sizeof(ports)) < 0)
+        {
+            return false;
+        }
+        sport = bpf_ntohs(ports[0]);
+        dport = bpf_ntohs(ports[1]);
+    }
+    return flow_side_match(f, src, dst, sport, dport, has_ports) ||
+           flow_side_match(f, dst, src, dport, sport, has_ports);
+}
+
+// Fill common fields, return bytes to copy for this record class
+static __always_inline u32
+fill_metadata(struct packet_metadata *meta, struct __sk_buff *skb, bool egress,
+              u32 snaplen, u32 class_len)
+{
+    if (egress)
+    {
+        meta->direction = 0;
+    }
+    else
+    {
+        meta->direction = 1;
+    }
+    meta->timestamp = bpf_ktime_get_ns();
+    meta->netifidx = skb->ifindex;
+    meta->payloadlen = skb->len;
+    // meta->pid = bpf_get_current_pid_tgid();
+    // bpf_get_current_comm(&meta->comm, sizeof(meta->comm));
+    u32 caplen = skb->len;
+    if (caplen > snaplen)
+    {
+        caplen = snaplen;
+    }
+    if (caplen > class_len)
+    {
+        caplen = class_len;
+    }
+    meta->caplen = caplen;
+    return caplen;
+}
+
 static __always_inline void
 handle_tc(struct __sk_buff *skb, bool egress)
 {
+    if (!flow_filter_pass(skb))
+    {
+        return;
+    }
 
     // Filter
     // Templated this struct
@@ -64,57 +279,65 @@ handle_tc(struct __sk_buff *skb, bool egress)
         // return;
     // }
     // }    
-    // void *ringbuf = NULL;
-    struct packet_metadata *meta;
-    // struct packet_payload *payload;
-    // Useless item put into zero
-    meta = events.ringbuf_reserve(sizeof(struct packet_metadata));
-    if (meta == NULL)
+    int zero = 0;
+    u32 snapclass = SNAP_CLASS_FULL;
+    u32 snaplen = SNAP_FULL_LEN;
+    struct capture_config *conf = capture_config.lookup(&zero);
+    if (conf != NULL && conf->snaplen > 0)
     {
-        return;
+        snapclass = conf->snapclass;
+        snaplen = conf->snaplen;
     }
-    
-    // meta = (struct packet_metadata *)ringbuf;
-    // __builtin_memset(meta,0,sizeof(struct packet_metadata)-2000);
-    if (egress)
+    // ringbuf_reserve needs a constant size, so every class has its own record
+    // BCC does not allow map calls inside macros, hence the repetition
+    if (snapclass == SNAP_CLASS_HEADER)
     {
-        meta->direction = 0;
+        struct packet_record_header *rec = events.ringbuf_reserve(sizeof(struct packet_record_header));
+        if (rec == NULL)
+        {
+            count_ring(RING_DROPPED);
+            return;
+        }
+        u32 caplen = fill_metadata(&rec->meta, skb, egress, snaplen, SNAP_HEADER_LEN);
+        if (caplen > 0 && caplen <= SNAP_HEADER_LEN)
+        {
+            bpf_skb_load_bytes(skb, 0, rec->payload, caplen);
+        }
+        events.ringbuf_submit(rec, 0);
+        count_ring(RING_SUBMITTED);
     }
-    else
+    else if (snapclass == SNAP_CLASS_MEDIUM)
     {
-        meta->direction = 1;
+        struct packet_record_medium *rec = events.ringbuf_reserve(sizeof(struct packet_record_medium));
+        if (rec == NULL)
+        {
+            count_ring(RING_DROPPED);
+            return;
+        }
+        u32 caplen = fill_metadata(&rec->meta, skb, egress, snaplen, SNAP_MEDIUM_LEN);
+        if (caplen > 0 && caplen <= SNAP_MEDIUM_LEN)
+        {
+            bpf_skb_load_bytes(skb, 0, rec->payload, caplen);
+        }
+        events.ringbuf_submit(rec, 0);
+        count_ring(RING_SUBMITTED);
     }
-    meta->timestamp = bpf_ktime_get_ns();
-    meta->netifidx = skb->ifindex;
-    // meta->pid = bpf_get_current_pid_tgid();
-    // bpf_get_current_comm(&meta->comm, sizeof(meta->comm));
-    u64 payload_len = (u64)skb->len;
-    meta->payloadlen = payload_len;
-    payload_len&=0xfff;
-    // meta->dport=dportnum;
-    // (dport >> 8) | ((dport << 8) & 0xff00)
-    // meta->lport=skb->local_port;
-    // if (skb->family == AF_INET6) {
-    //     meta->family=6;
-    //     bpf_probe_read(&meta->ipv6__recvaddr, sizeof(skb->local_ip6),
-    //                    &skb->local_ip6);
-    //     bpf_probe_read(&meta->ipv6__sendaddr, sizeof(skb->remote_ip6),
-    //                    &skb->remote_ip6);
-    // }
-	// else
-	// {
-    //     meta->family=4;
-	// 	meta->ipv4__recvaddr=skb->local_ip4;
-	// 	meta->ipv4__sendaddr=skb->remote_ip4;
-	// }
-    if (payload_len > 0)
+    else
     {
-        // payload = (struct skb_data_t *)(meta + 1);
-        
-        bpf_skb_load_bytes(skb, 0, &meta->payload, payload_len);
+        struct packet_record_full *rec = events.ringbuf_reserve(sizeof(struct packet_record_full));
+        if (rec == NULL)
+        {
+            count_ring(RING_DROPPED);
+            return;
+        }
+        u32 caplen = fill_metadata(&rec->meta, skb, egress, snaplen, SNAP_FULL_LEN);
+        if (caplen > 0 && caplen <= SNAP_FULL_LEN)
+        {
+            bpf_skb_load_bytes(skb, 0, rec->payload, caplen);
+        }
+        events.ringbuf_submit(rec, 0);
+        count_ring(RING_SUBMITTED);
     }
-    events.ringbuf_submit(meta, 0);
-
     return;
 }
 
@@ -38,9 +38,107 @@ struct packet_metadata
     u64 payloadlen;
     u8 payloadHdr[58];
 };
-BPF_RINGBUF_OUTPUT(events, 512);
+// Pages of the ring, AttachAndRunProbers passes -DEVENTS_RING_PAGES from TRACER_FUNC_RING_PAGES
+#ifndef EVENTS_RING_PAGES
+#define EVENTS_RING_PAGES 512
+#endif
+BPF_RINGBUF_OUTPUT(events, EVENTS_RING_PAGES);
 BPF_RINGBUF_OUTPUT(SpecEvents, 128);
 
+// Per CPU ring accounting for /Stats: events submitted, and events lost because the ring was full
+#define RING_SUBMITTED 0
+#define RING_DROPPED 1
+BPF_PERCPU_ARRAY(ring_stats, u64, 2);
+
+static inline __attribute__((always_inline)) void count_ring(u32 slot)
+{
+    u64 *value = ring_stats.lookup(&slot);
+    if(value){*value += 1;}
+}
+
+// Flow filter written by AttachAndRunProbers.SetFlowFilter (/SetFilter), addresses in the form of
+// struct SkProbe. While enabled, generic calls are only submitted from a thread inside a SpecList
+// call on the flow, in either direction.
+struct call_filter
+{
+    u64 enabled;
+    u64 family;
+    u64 srcport;
+    u64 dstport;
+    u32 srcaddr4;
+    u32 dstaddr4;
+    u8 srcaddr6[16];
+    u8 dstaddr6[16];
+};
+BPF_ARRAY(call_filter, struct call_filter, 1);
+
+// Per thread id: send calls (tcp_sendmsg...) on the flow it is inside, and whether ip_rcv_core/ip6_rcv_core
+// matched under the ip_rcv/ipv6_rcv/ip_list_rcv/ipv6_list_rcv call it is in, the rest of that receive follows
+struct flow_thread
+{
+    u32 calls;
+    u32 receive;
+};
+BPF_HASH(flow_threads, u32, struct flow_thread, 16384);
+
+static inline __attribute__((always_inline)) int same_addr6(const u8 *a, const u8 *b)
+{
+    const u64 *x = (const u64 *)a;
+    const u64 *y = (const u64 *)b;
+    return x[0] == y[0] && x[1] == y[1];
+}
+
+static inline __attribute__((always_inline)) int flow_match(struct call_filter *f, struct SkProbe *data)
+{
+    if(data->family != f->family){return 0;}
+    int forward, backward;
+    if(data->family == 4)
+    {
+        forward = data->ipv4__sendaddr == f->srcaddr4 && data->ipv4__recvaddr == f->dstaddr4;
+        backward = data->ipv4__sendaddr == f->dstaddr4 && data->ipv4__recvaddr == f->srcaddr4;
+    }
+    else
+    {
+        forward = same_addr6(data->ipv6__sendaddr, f->srcaddr6) && same_addr6(data->ipv6__recvaddr, f->dstaddr6);
+        backward = same_addr6(data->ipv6__sendaddr, f->dstaddr6) && same_addr6(data->ipv6__recvaddr, f->srcaddr6);
+    }
+    if(!forward && !backward){return 0;}
+    return (data->lport == f->srcport && data->dport == f->dstport) ||
+           (data->lport == f->dstport && data->dport == f->srcport);
+}
+
+static inline __attribute__((always_inline)) void enter_flow(struct SkProbe *data, int receive)
+{
+    u32 zero = 0;
+    struct call_filter *f = call_filter.lookup(&zero);
+    if(!f || !f->enabled || !flow_match(f, data)){return;}
+    u32 tid = bpf_get_current_pid_tgid();
+    struct flow_thread init = {};
+    struct flow_thread *state = flow_threads.lookup_or_try_init(&tid, &init);
+    if(!state){return;}
+    if(receive){state->receive = 1;}
+    else{state->calls += 1;}
+}
+
+static inline __attribute__((always_inline)) void leave_flow(int receive)
+{
+    u32 tid = bpf_get_current_pid_tgid();
+    struct flow_thread *state = flow_threads.lookup(&tid);
+    if(!state){return;}
+    if(receive){state->receive = 0;}
+    else if(state->calls > 0){state->calls -= 1;}
+    if(state->calls == 0 && state->receive == 0){flow_threads.delete(&tid);}
+}
+
+static inline __attribute__((always_inline)) int flow_active(void)
+{
+    u32 zero = 0;
+    struct call_filter *f = call_filter.lookup(&zero);
+    if(!f || !f->enabled){return 1;}
+    u32 tid = bpf_get_current_pid_tgid();
+    return flow_threads.lookup(&tid) != NULL;
+}
+
 """
 
 SpecialPartRcvBackup="""
@@ -201,7 +299,7 @@ SpecialPartRcv="""
 int ktprobe_ip_rcv_core(struct pt_regs *ctx,struct sk_buff *skb)
 {
 struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-if(!data){{return 0;}}
+if(!data){{count_ring(RING_DROPPED);return 0;}}
 //struct sock *sk = skb->sk;
 u8 *data_s = (u8 *)(long)skb->data;
 u8 *data_end = (u8 *)(long)skb->tail;
@@ -214,7 +312,7 @@ if(skb->len<16)
 {
     data->family = (long)skb->data;
     data->dport = (long)skb->tail;
-    events.ringbuf_submit(data, 0);
+events.ringbuf_submit(data, 0);
     return 0;
     // No complete Eth layer
 }
@@ -252,7 +350,9 @@ else if(ipver==96)
     }
     // ipv6
 }
+enter_flow(data, 1);
 events.ringbuf_submit(data, 0);
+count_ring(RING_SUBMITTED);
 
 return 0;
 }
@@ -260,19 +360,20 @@ return 0;
 int ktretprobe_ip_rcv_core(struct pt_regs *ctx)
 {
 struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-if(!data){{return 0;}}
+if(!data){{count_ring(RING_DROPPED);return 0;}}
 data->FuncID=200000;
 data->kernelTime = bpf_ktime_get_ns();
 data->pid=bpf_get_current_pid_tgid();
 data->ret=1;
 events.ringbuf_submit(data, 0);
+count_ring(RING_SUBMITTED);
 return 0;
 }
 
 int ktprobe_ip6_rcv_core(struct pt_regs *ctx,struct sk_buff *skb)
 {
 struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-if(!data){{return 0;}}
+if(!data){{count_ring(RING_DROPPED);return 0;}}
 //struct sock *sk = skb->sk;
 u8 *data_s = (u8 *)(long)skb->data;
 u8 *data_end = (u8 *)(long)skb->tail;
@@ -285,7 +386,7 @@ if(skb->len<16)
 {
     data->family = (long)skb->data;
     data->dport = (long)skb->tail;
-    events.ringbuf_submit(data, 0);
+events.ringbuf_submit(data, 0);
     return 0;
     // No complete Eth layer
 }
@@ -323,19 +424,22 @@ else if(ipver==96)
     }
     // ipv6
 }
+enter_flow(data, 1);
 events.ringbuf_submit(data, 0);
+count_ring(RING_SUBMITTED);
 return 0;
 }
 
 int ktretprobe_ip6_rcv_core(struct pt_regs *ctx)
 {
 struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-if(!data){{return 0;}}
+if(!data){{count_ring(RING_DROPPED);return 0;}}
 data->FuncID=200001;
 data->kernelTime = bpf_ktime_get_ns();
 data->pid=bpf_get_current_pid_tgid();
 data->ret=1;
 events.ringbuf_submit(data, 0);
+count_ring(RING_SUBMITTED);
 return 0;
 }
 
@@ -345,7 +449,7 @@ SpecialPartSnd="""
 int ktprobe_icmp_push_reply(struct pt_regs *ctx, struct sock *sk)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->kernelTime = bpf_ktime_get_ns();
     data->pid = bpf_get_current_pid_tgid();
     data->FuncID=200002;
@@ -368,26 +472,30 @@ int ktprobe_icmp_push_reply(struct pt_regs *ctx, struct sock *sk)
         data->ipv4__recvaddr = sk->__sk_common.skc_daddr;
         data->ipv4__sendaddr = sk->__sk_common.skc_rcv_saddr;
     }
+    enter_flow(data, 0);
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktretprobe_icmp_push_reply(struct pt_regs *ctx)
 {
+    leave_flow(0);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->FuncID=200002;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktprobe_raw_sendmsg(struct pt_regs *ctx, struct sock *sk)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->kernelTime = bpf_ktime_get_ns();
     data->pid = bpf_get_current_pid_tgid();
     data->FuncID=200003;
@@ -410,26 +518,30 @@ int ktprobe_raw_sendmsg(struct pt_regs *ctx, struct sock *sk)
         data->ipv4__recvaddr = sk->__sk_common.skc_daddr;
         data->ipv4__sendaddr = sk->__sk_common.skc_rcv_saddr;
     }
+    enter_flow(data, 0);
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktretprobe_raw_sendmsg(struct pt_regs *ctx)
 {
+    leave_flow(0);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->FuncID=200003;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktprobe_rawv6_sendmsg(struct pt_regs *ctx, struct sock *sk)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->kernelTime = bpf_ktime_get_ns();
     data->pid = bpf_get_current_pid_tgid();
     data->FuncID=200004;
@@ -452,26 +564,30 @@ int ktprobe_rawv6_sendmsg(struct pt_regs *ctx, struct sock *sk)
         data->ipv4__recvaddr = sk->__sk_common.skc_daddr;
         data->ipv4__sendaddr = sk->__sk_common.skc_rcv_saddr;
     }
+    enter_flow(data, 0);
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktretprobe_rawv6_sendmsg(struct pt_regs *ctx)
 {
+    leave_flow(0);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->FuncID=200004;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktprobe_udp_sendmsg(struct pt_regs *ctx, struct sock *sk)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->kernelTime = bpf_ktime_get_ns();
     data->pid = bpf_get_current_pid_tgid();
     data->FuncID=200005;
@@ -494,26 +610,30 @@ int ktprobe_udp_sendmsg(struct pt_regs *ctx, struct sock *sk)
         data->ipv4__recvaddr = sk->__sk_common.skc_daddr;
         data->ipv4__sendaddr = sk->__sk_common.skc_rcv_saddr;
     }
+    enter_flow(data, 0);
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktretprobe_udp_sendmsg(struct pt_regs *ctx)
 {
+    leave_flow(0);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->FuncID=200005;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktprobe_udpv6_sendmsg(struct pt_regs *ctx, struct sock *sk)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->kernelTime = bpf_ktime_get_ns();
     data->pid = bpf_get_current_pid_tgid();
     data->FuncID=200006;
@@ -536,25 +656,29 @@ int ktprobe_udpv6_sendmsg(struct pt_regs *ctx, struct sock *sk)
         data->ipv4__recvaddr = sk->__sk_common.skc_daddr;
         data->ipv4__sendaddr = sk->__sk_common.skc_rcv_saddr;
     }
+    enter_flow(data, 0);
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktretprobe_udpv6_sendmsg(struct pt_regs *ctx)
 {
+    leave_flow(0);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->FuncID=200006;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 int ktprobe_tcp_sendmsg(struct pt_regs *ctx, struct sock *sk)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->kernelTime = bpf_ktime_get_ns();
     data->pid = bpf_get_current_pid_tgid();
     data->FuncID=200007;
@@ -577,19 +701,23 @@ int ktprobe_tcp_sendmsg(struct pt_regs *ctx, struct sock *sk)
         data->ipv4__recvaddr = sk->__sk_common.skc_daddr;
         data->ipv4__sendaddr = sk->__sk_common.skc_rcv_saddr;
     }
+    enter_flow(data, 0);
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 
 int ktretprobe_tcp_sendmsg(struct pt_regs *ctx)
 {
+    leave_flow(0);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
     data->FuncID=200007;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 """
@@ -598,116 +726,264 @@ SpecialPartListen="""
 int ktprobe_ip_rcv(struct pt_regs *ctx)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){return 0;}
+    if(!data){count_ring(RING_DROPPED);return 0;}
     data->FuncID=300000;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=0;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 int ktretprobe_ip_rcv(struct pt_regs *ctx)
 {
+    leave_flow(1);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){return 0;}
+    if(!data){count_ring(RING_DROPPED);return 0;}
     data->FuncID=300000;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 int ktprobe_ipv6_rcv(struct pt_regs *ctx)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){return 0;}
+    if(!data){count_ring(RING_DROPPED);return 0;}
     data->FuncID=300001;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=0;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 int ktretprobe_ipv6_rcv(struct pt_regs *ctx)
 {
+    leave_flow(1);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){return 0;}
+    if(!data){count_ring(RING_DROPPED);return 0;}
     data->FuncID=300001;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 int ktprobe_ip_list_rcv(struct pt_regs *ctx)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){return 0;}
+    if(!data){count_ring(RING_DROPPED);return 0;}
     data->FuncID=300002;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=0;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 int ktretprobe_ip_list_rcv(struct pt_regs *ctx)
 {
+    leave_flow(1);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){return 0;}
+    if(!data){count_ring(RING_DROPPED);return 0;}
     data->FuncID=300002;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 int ktprobe_ipv6_list_rcv(struct pt_regs *ctx)
 {
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){return 0;}
+    if(!data){count_ring(RING_DROPPED);return 0;}
     data->FuncID=300003;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=0;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 int ktretprobe_ipv6_list_rcv(struct pt_regs *ctx)
 {
+    leave_flow(1);
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){return 0;}
+    if(!data){count_ring(RING_DROPPED);return 0;}
     data->FuncID=300003;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
     data->ret=1;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }
 """
 
-KproberBody="""
-int ktprobe_{0}(struct pt_regs *ctx)
+# Every generic function shares one entry and one return program, the FuncID comes from
+# funcids (function address -> FuncID, filled by AttachAndRunProbers from /proc/kallsyms)
+# for plain kprobes, and from the link cookie for kprobe.multi (see KprobeMulti).
+# With call_mode 1 (TRACER_CALLS=histogram) no event is submitted, the calls only go into
+# per function log2 histograms of their duration in ns, read by /GetFuncLatency.
+# func_enabled has one bit per FuncID, calls of a function whose bit is clear are dropped
+# first thing (/SetFuncEnabled), AttachAndRunProbers sets every bit after loading.
+# Functions over the call budget are sampled or only counted through func_throttle (/SetThrottle).
+# {0} is the size of funcids, {1} the number of 64 bit words of func_enabled, {2} the number of
+# distinct FuncIDs, the size of the maps keyed by FuncID. FuncIDs are sparse BTF ids, so these are
+# hashes rather than arrays. The per CPU ones are not preallocated: nothing is reserved until a
+# function is counted or timed, and call_latency stays empty in the default events mode
+GenericProbePart="""
+BPF_HASH(funcids, u64, u64, {0});
+BPF_ARRAY(func_enabled, u64, {1});
+
+static inline __attribute__((always_inline)) int func_on(u64 funcid)
 {{
-    struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
-    data->FuncID={1};
-    data->kernelTime = bpf_ktime_get_ns();
-    data->pid=bpf_get_current_pid_tgid();
-    data->ret=0;
-    events.ringbuf_submit(data, 0);
+    u32 word = funcid >> 6;
+    u64 *bits = func_enabled.lookup(&word);
+    return bits && ((*bits >> (funcid & 63)) & 1);
+}}
+
+#define LATENCY_SLOTS 40
+// 0 submits call events, 1 only fills call_latency
+BPF_ARRAY(call_mode, u64, 1);
+struct call_start_key
+{{
+    u64 funcid;
+    u32 tid;
+    u32 padding;
+}};
+// Entry time of the calls in progress, returns that are never seen age out
+BPF_TABLE("lru_hash", struct call_start_key, u64, call_start, 65536);
+// Slot i counts the durations d with bpf_log2l(d) == i
+struct latency_hist
+{{
+    u64 calls;
+    u64 slots[LATENCY_SLOTS];
+}};
+BPF_F_TABLE("percpu_hash", u64, struct latency_hist, call_latency, {2}, BPF_F_NO_PREALLOC);
+
+static inline __attribute__((always_inline)) int record_latency(u64 funcid, u64 ret)
+{{
+    struct call_start_key key = {{}};
+    key.funcid = funcid;
+    key.tid = bpf_get_current_pid_tgid();
+    u64 now = bpf_ktime_get_ns();
+    if(!ret)
+    {{
+        call_start.update(&key, &now);
+        return 0;
+    }}
+    u64 *begin = call_start.lookup(&key);
+    if(!begin){{return 0;}}
+    u64 slot = bpf_log2l(now - *begin);
+    call_start.delete(&key);
+    struct latency_hist empty = {{}};
+    struct latency_hist *hist = call_latency.lookup_or_try_init(&funcid, &empty);
+    if(!hist){{return 0;}}
+    if(slot >= LATENCY_SLOTS){{slot = LATENCY_SLOTS - 1;}}
+    hist->calls += 1;
+    hist->slots[slot] += 1;
     return 0;
 }}
-int ktretprobe_{0}(struct pt_regs *ctx)
+
+// Calls entering each function, read every second by AttachAndRunProbers to find hot functions
+BPF_F_TABLE("percpu_hash", u64, u64, call_counts, {2}, BPF_F_NO_PREALLOC);
+#define THROTTLE_COUNT_ONLY 0xffffffff
+// FuncID -> only 1 in N of its calls submitted, THROTTLE_COUNT_ONLY none, absent for unthrottled functions
+BPF_HASH(func_throttle, u64, u32, {2});
+// Sampled calls in progress, their return is submitted too
+BPF_TABLE("lru_hash", struct call_start_key, u8, sampled_calls, 65536);
+
+static inline __attribute__((always_inline)) u64 count_call(u64 funcid)
 {{
+    u64 zero = 0;
+    u64 *count = call_counts.lookup_or_try_init(&funcid, &zero);
+    if(!count){{return 0;}}
+    *count += 1;
+    return *count;
+}}
+
+static inline __attribute__((always_inline)) int throttle_pass(u64 funcid, u64 ret, u64 count)
+{{
+    u32 *sample = func_throttle.lookup(&funcid);
+    if(!sample || *sample <= 1){{return 1;}}
+    if(*sample == THROTTLE_COUNT_ONLY){{return 0;}}
+    struct call_start_key key = {{}};
+    key.funcid = funcid;
+    key.tid = bpf_get_current_pid_tgid();
+    if(!ret)
+    {{
+        if(count % *sample){{return 0;}}
+        u8 one = 1;
+        sampled_calls.update(&key, &one);
+        return 1;
+    }}
+    if(!sampled_calls.lookup(&key)){{return 0;}}
+    sampled_calls.delete(&key);
+    return 1;
+}}
+
+static inline __attribute__((always_inline)) int submit_call(u64 funcid, u64 ret)
+{{
+    if(!func_on(funcid)){{return 0;}}
+    if(!flow_active()){{return 0;}}
+    u64 count = ret ? 0 : count_call(funcid);
+    u32 zero = 0;
+    u64 *mode = call_mode.lookup(&zero);
+    if(mode && *mode == 1){{return record_latency(funcid, ret);}}
+    if(!throttle_pass(funcid, ret, count)){{return 0;}}
     struct SkProbe *data = events.ringbuf_reserve(sizeof(struct SkProbe));
-    if(!data){{return 0;}}
-    data->FuncID={1};
+    if(!data){{count_ring(RING_DROPPED);return 0;}}
+    data->FuncID=funcid;
     data->kernelTime = bpf_ktime_get_ns();
     data->pid=bpf_get_current_pid_tgid();
-    data->ret=1;
+    data->ret=ret;
     events.ringbuf_submit(data, 0);
+    count_ring(RING_SUBMITTED);
     return 0;
 }}
+int ktgenericprobe(struct pt_regs *ctx)
+{{
+    u64 ip = bpf_get_func_ip(ctx);
+    u64 *funcid = funcids.lookup(&ip);
+    if(!funcid){{return 0;}}
+    return submit_call(*funcid, 0);
+}}
+int ktgenericretprobe(struct pt_regs *ctx)
+{{
+    u64 ip = bpf_get_func_ip(ctx);
+    u64 *funcid = funcids.lookup(&ip);
+    if(!funcid){{return 0;}}
+    return submit_call(*funcid, 1);
+}}
+int ktmultiprobe(struct pt_regs *ctx)
+{{
+    return submit_call(bpf_get_attach_cookie(ctx), 0);
+}}
+int ktmultiretprobe(struct pt_regs *ctx)
+{{
+    return submit_call(bpf_get_attach_cookie(ctx), 1);
+}}
+
+"""
+
+# Same events through BPF trampolines, one pair per function since a trampoline program
+# is loaded for a single target. Only emitted for TRACER_PROBE=fentry.
+# The macros name the programs kfunc__vmlinux__<func> and kretfunc__vmlinux__<func>
+KfuncBody="""
+KFUNC_PROBE({0})
+{{
+    return submit_call({1}, 0);
+}}
+KRETFUNC_PROBE({0})
+{{
+    return submit_call({1}, 1);
+}}
 
 """
 DisabledList=["____sys_recvmsg","___sys_recvmsg","sock_recvmsg","security_socket_recvmsg",
@@ -732,7 +1008,8 @@ SpecList=["ip_rcv_core","ip6_rcv_core","icmp_push_reply","rawv6_sendmsg",
         #   "raw_sendmsg","udp_sendmsg","udpv6_sendmsg","tcp_sendmsg",
         #   ]
 # Commonly Applied
-def translateJSON():
+def translateJSON(fentry=False):
+    # fentry: also emit the KfuncBody programs, every function of relatedFuncD5.json comes from BTF
     fo=open("./.cache/relatedFuncD5.json","r")
     fw=open("./.cache/FuncIDMap.json","w")
     mainFile=js.load(fo)
@@ -770,10 +1047,15 @@ def translateJSON():
             # if(item["name"]=="tcp_recvmsg"):
             FuncList.append((item["name"],item["id"]))
 
-    BPFFile=KproberHeader+SpecialPartRcv+SpecialPartSnd+SpecialPartListen
+    # Duplicate static symbols give a function more than one address
+    addresses=max(4*len(FuncList),1024)
+    words=max([item[1] for item in FuncList],default=0)//64+1
+    funcids=max(len({item[1] for item in FuncList}),1)
+    BPFFile=KproberHeader+SpecialPartRcv+SpecialPartSnd+SpecialPartListen+GenericProbePart.format(addresses,words,funcids)
 
-    for item in FuncList:
-        BPFFile+=KproberBody.format(item[0],item[1])
+    if fentry:
+        for item in FuncList:
+            BPFFile+=KfuncBody.format(item[0],item[1])
     f=open("./.cache/kProberFunc.c","w")
     f.write(BPFFile)
     f.close()